@@ -0,0 +1,226 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# Copyright (c) 2025 vivo Mobile Communication Co., Ltd.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+'''
+Pre-submit checks of a merge request, run as a DAG of tasks over a worker
+pool. The changed files of every repo are computed once by a diff task which
+the format and license tasks of the repo depend on, so the checks of all
+repos run concurrently.
+'''
+
+import sys
+import argparse
+import concurrent.futures
+from pathlib import Path
+from run_check_fmt import BASE_HELP, check_files_format, get_changed_files, parse_bases, print_format_errors
+from run_check_license import check_repo_license, needs_license, print_license_errors
+
+DIFF = 'diff'
+FORMAT = 'format'
+LICENSE = 'license'
+
+
+class Task(object):
+
+    def __init__(self, name, fn, deps):
+        self.name = name
+        self.fn = fn
+        self.deps = deps
+
+
+class Presubmit(object):
+    '''
+    A task runs as soon as all of its dependencies have succeeded and is
+    called with their results, in the order of `deps`. Tasks depending on a
+    failed task are skipped. Tasks mostly wait for subprocesses, so by
+    default every task gets its own worker.
+    '''
+
+    def __init__(self, jobs=None):
+        self.jobs = jobs
+        self.tasks = {}
+        self.results = {}
+        # Exceptions raised by failed tasks.
+        self.errors = {}
+        self.skipped = []
+
+    def add(self, name, fn, deps=()):
+        # Dependencies must be added first, which keeps the graph acyclic.
+        for dep in deps:
+            if dep not in self.tasks:
+                raise ValueError(f'Unknown dependency {dep} of {name}')
+        self.tasks[name] = Task(name, fn, list(deps))
+        return name
+
+    def ready(self, pending):
+        '''Pops the tasks of `pending` that can run and skips the ones which
+        never will.'''
+        ready = []
+        # Tasks are in topological order, so skips cascade in one pass.
+        for task in list(pending):
+            if any(dep in self.errors or dep in self.skipped
+                   for dep in task.deps):
+                pending.remove(task)
+                self.skipped.append(task.name)
+            elif all(dep in self.results for dep in task.deps):
+                pending.remove(task)
+                ready.append(task)
+        return ready
+
+    def run(self):
+        '''Returns whether all tasks have succeeded.'''
+        pending = list(self.tasks.values())
+        running = {}
+        jobs = self.jobs or max(1, len(pending))
+        with concurrent.futures.ThreadPoolExecutor(max_workers=jobs) as pool:
+            while True:
+                for task in self.ready(pending):
+                    args = [self.results[dep] for dep in task.deps]
+                    running[pool.submit(task.fn, *args)] = task
+                if not running:
+                    break
+                done, _ = concurrent.futures.wait(
+                    running, return_when=concurrent.futures.FIRST_COMPLETED)
+                for future in done:
+                    task = running.pop(future)
+                    try:
+                        self.results[task.name] = future.result()
+                    except Exception as e:
+                        self.errors[task.name] = e
+        return not self.errors and not self.skipped
+
+    def issues(self, kind):
+        '''Issues reported by the tasks of `kind`, in the order of tasks.'''
+        issues = []
+        # Results are filled in as tasks complete, tasks are in order.
+        for name in self.tasks:
+            if name.startswith(f'{kind}:') and name in self.results:
+                issues.extend(self.results[name])
+        return issues
+
+
+def presubmit_tasks(repos,
+                    bases=None,
+                    offline=False,
+                    full_license=False,
+                    jobs=None):
+    '''
+    Format and license checks of the changed files of `repos`, see
+    `run_check_fmt.get_changed_files_of` for `bases` and `offline`. Licenses
+    of whole repos are checked if `full_license` is set.
+    '''
+    presubmit = Presubmit(jobs)
+    bases = bases or {}
+    for repo in [repo.strip() for repo in repos]:
+        diff = presubmit.add(f'{DIFF}:{repo}',
+                             lambda repo=repo: get_changed_files(
+                                 repo, bases.get(repo), offline))
+        presubmit.add(f'{FORMAT}:{repo}',
+                      lambda files, repo=repo: check_files_format(repo, files),
+                      [diff])
+        if not needs_license(repo):
+            continue
+        if full_license:
+            presubmit.add(f'{LICENSE}:{repo}',
+                          lambda repo=repo: check_repo_license(repo))
+        else:
+            presubmit.add(
+                f'{LICENSE}:{repo}',
+                lambda files, repo=repo: check_repo_license(repo, files),
+                [diff])
+    return presubmit
+
+
+def report(presubmit):
+    '''Prints what the checks have found, returns whether they passed.'''
+    for name in presubmit.tasks:
+        if name in presubmit.errors:
+            print(f'❌ {name} failed: {presubmit.errors[name]}')
+    for name in presubmit.skipped:
+        print(f'❌ {name} skipped')
+    format_errors = presubmit.issues(FORMAT)
+    if format_errors:
+        print_format_errors(format_errors)
+    license_errors = presubmit.issues(LICENSE)
+    if license_errors:
+        print_license_errors(license_errors)
+    passed = not presubmit.errors and not presubmit.skipped and not (
+        format_errors or license_errors)
+    if passed:
+        print('✅ Presubmit checks passed!')
+    sys.stdout.flush()
+    return passed
+
+
+def run_presubmit(repos, *args, **kwargs):
+    '''Runs the checks of `presubmit_tasks`, returns whether they passed.'''
+    print(f'🔍 Running presubmit checks of {repos} ...')
+    presubmit = presubmit_tasks(repos, *args, **kwargs)
+    presubmit.run()
+    return report(presubmit)
+
+
+def start_presubmit(repos, *args, **kwargs):
+    '''Like `run_presubmit`, but returns a Future of its result at once.'''
+    pool = concurrent.futures.ThreadPoolExecutor(max_workers=1)
+    future = pool.submit(run_presubmit, repos, *args, **kwargs)
+    pool.shutdown(wait=False)
+    return future
+
+
+def has_failed(gate):
+    '''Whether the presubmit Future `gate` is known to have failed.'''
+    return gate is not None and gate.done() and (gate.exception() is not None
+                                                 or not gate.result())
+
+
+def main():
+    kernel_root = str(Path(__file__).resolve().parent.parent.parent)
+
+    parser = argparse.ArgumentParser(
+        description='Run presubmit checks of BlueOS kernel repos')
+    parser.add_argument('--jobs',
+                        type=int,
+                        help='Number of tasks to run concurrently')
+    parser.add_argument(
+        '--offline',
+        action='store_true',
+        help=
+        'Diff against the merge-base with the local origin/<branch>, without fetching'
+    )
+    parser.add_argument('--base', action='append', help=BASE_HELP)
+    parser.add_argument('--full_license',
+                        action='store_true',
+                        help='Check license headers of whole repos')
+    parser.add_argument('repo_paths',
+                        nargs='*',
+                        default=[kernel_root],
+                        help='Repository paths to check')
+    args = parser.parse_args()
+    try:
+        bases = parse_bases(args.repo_paths, args.base)
+    except ValueError as e:
+        parser.error(str(e))
+    if not run_presubmit(args.repo_paths,
+                         bases,
+                         args.offline,
+                         args.full_license,
+                         jobs=args.jobs):
+        return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
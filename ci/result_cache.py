@@ -0,0 +1,181 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# Copyright (c) 2025 vivo Mobile Communication Co., Ltd.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+'''
+On-disk store of CI configs that have passed, keyed by a fingerprint of
+everything that may affect the result of the config.
+A config whose fingerprint has a recorded pass doesn't need to run again.
+'''
+
+import os
+import json
+import time
+import hashlib
+import subprocess
+import xml.etree.ElementTree as ET
+from typing import List
+
+# The build repo, i.e. <kernel_root>/build.
+BUILD_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# The repo workspace, whose manifest lists every source repo.
+WORKSPACE = os.path.dirname(os.path.dirname(BUILD_ROOT))
+
+# Directories of the build repo that don't affect a single config. Files of
+# the config's own board are hashed by `Runner.fingerprint`.
+IGNORED_BUILD_DIRS = ['boards', 'ci', 'out', '__pycache__']
+
+TOOL_VERSION_CMDS = [
+    ['gn', '--version'],
+    ['ninja', '--version'],
+    ['rustc', '-vV'],
+    ['clang', '--version'],
+]
+
+
+def hash_file(h, path, name):
+    h.update(name.encode())
+    with open(path, 'rb') as f:
+        while True:
+            chunk = f.read(1 << 20)
+            if not chunk:
+                break
+            h.update(chunk)
+
+
+def hash_tree(h, root, ignored_dirs=()):
+    for dirpath, dirnames, filenames in os.walk(root):
+        dirnames[:] = sorted(
+            d for d in dirnames
+            if not d.startswith('.') and d not in ignored_dirs)
+        for filename in sorted(filenames):
+            path = os.path.join(dirpath, filename)
+            # Skip broken symlinks, sockets and the like.
+            if os.path.isfile(path):
+                hash_file(h, path, os.path.relpath(path, root))
+
+
+def hash_git_repo(h, repo):
+    '''
+    Hash HEAD, local modifications and untracked files of a repo.
+    Returns False if `repo` is not a git repo.
+    '''
+
+    def git(*args):
+        return subprocess.run(['git', '-C', repo] + list(args),
+                              check=True,
+                              capture_output=True).stdout
+
+    try:
+        h.update(git('rev-parse', 'HEAD^{tree}'))
+        h.update(git('diff', 'HEAD', '--binary'))
+        untracked = git('ls-files', '--others', '--exclude-standard', '-z')
+    except (subprocess.CalledProcessError, FileNotFoundError):
+        return False
+    for path in sorted(untracked.split(b'\0')):
+        path = path.decode()
+        # Nested repos are listed as `sub/`, broken symlinks can't be read.
+        if path and os.path.isfile(os.path.join(repo, path)):
+            hash_file(h, os.path.join(repo, path), path)
+    return True
+
+
+def workspace_repos():
+    '''Paths of all projects of the repo manifest, empty without one.'''
+    manifest = os.path.join(WORKSPACE, '.repo', 'manifests', 'manifest.xml')
+    if not os.path.exists(manifest):
+        return []
+    root = ET.parse(manifest).getroot()
+    return [
+        os.path.join(WORKSPACE, project.get('path', project.get('name')))
+        for project in root.findall('project')
+    ]
+
+
+def tool_versions(h):
+    for cmd in TOOL_VERSION_CMDS:
+        h.update(' '.join(cmd).encode())
+        try:
+            h.update(subprocess.run(cmd, capture_output=True).stdout)
+        except FileNotFoundError:
+            h.update(b'missing')
+
+
+def common_fingerprint(repo_paths: List[str]):
+    '''
+    Fingerprint of the inputs shared by all configs: the build repo, the
+    source repos and the tool versions. Source repos are `repo_paths` and
+    every project of the workspace manifest, so that a repo missing on the
+    command line still invalidates recorded passes.
+    Returns None if some source repo can't be hashed, which disables caching.
+    '''
+    h = hashlib.sha256()
+    hash_tree(h, BUILD_ROOT, IGNORED_BUILD_DIRS)
+    repos = set(
+        os.path.realpath(repo.strip())
+        for repo in list(repo_paths) + workspace_repos())
+    if not repos:
+        repos = [os.path.dirname(BUILD_ROOT)]
+    for repo in sorted(repos):
+        h.update(repo.encode())
+        # Projects not synced to this workspace can't affect the build.
+        if not os.path.exists(repo):
+            h.update(b'missing')
+            continue
+        if not hash_git_repo(h, repo):
+            return None
+    tool_versions(h)
+    return h.hexdigest()
+
+
+class ResultCache(object):
+
+    def __init__(self, cache_dir):
+        self.cache_dir = cache_dir
+        self.hits = []
+        self.misses = []
+
+    def entry(self, fingerprint):
+        return os.path.join(self.cache_dir, f'{fingerprint}.json')
+
+    def has_pass(self, fingerprint):
+        return fingerprint is not None and os.path.exists(
+            self.entry(fingerprint))
+
+    def lookup(self, config, fingerprint):
+        if self.has_pass(fingerprint):
+            self.hits.append(config)
+            return True
+        self.misses.append(config)
+        return False
+
+    def record_pass(self, config, fingerprint):
+        if fingerprint is None:
+            return
+        os.makedirs(self.cache_dir, exist_ok=True)
+        path = self.entry(fingerprint)
+        # Configs may finish concurrently, write each entry atomically.
+        tmp = f'{path}.{os.getpid()}.tmp'
+        with open(tmp, 'w') as f:
+            json.dump({'config': config.name(), 'time': time.time()}, f)
+        os.replace(tmp, path)
+
+    def report(self):
+        print(f'Result cache: {len(self.hits)} hit(s), '
+              f'{len(self.misses)} miss(es)')
+        for config in self.hits:
+            print(f'  hit : {config.name()}')
+        for config in self.misses:
+            print(f'  miss: {config.name()}')
@@ -15,64 +15,277 @@
 # limitations under the License.
 
 import argparse
+import functools
+import hashlib
+import os
 import subprocess
 import sys
 import shutil
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
-from typing import List, Tuple
+from typing import Dict, List, Tuple
 import platform
 import xml.etree.ElementTree as ET
 
 
+@functools.lru_cache(maxsize=None)
+def load_manifest(manifest_path: Path) -> Tuple[Dict[str, str], str]:
+    """Parses manifest.xml once into project name -> revision and the
+    default revision"""
+    revisions = {}
+    default_revision = "main"
+    if manifest_path.exists():
+        root = ET.parse(manifest_path).getroot()
+        for project in root.findall("project"):
+            if project.get("revision"):
+                revisions.setdefault(project.get("name"),
+                                     project.get("revision"))
+        default = root.find("default")
+        if default is not None:
+            default_revision = default.get("revision", "main")
+    return revisions, default_revision
+
+
 def get_default_branch(repo: str) -> str:
     """Get default branch from manifest.xml, checking project revision then default revision"""
     manifest_path = Path(repo).parent / ".repo" / "manifests" / "manifest.xml"
-    if manifest_path.exists():
-        tree = ET.parse(manifest_path)
-        root = tree.getroot()
+    revisions, default_revision = load_manifest(manifest_path)
+    return revisions.get(Path(repo).name, default_revision)
 
-        # Get project name from repo path
-        repo_name = Path(repo).name
 
-        # Check project-specific revision first
-        for project in root.findall("project"):
-            if project.get("name") == repo_name:
-                revision = project.get("revision")
-                if revision:
-                    return revision
+def get_diff_base(repo: str, base: str = None, offline: bool = False) -> str:
+    """Returns the commit to diff against. `base` is used as is. Offline,
+    it's the merge-base of HEAD and the locally known origin/<branch>,
+    otherwise origin/<branch> is fetched first."""
+    if base:
+        return base
+    default_branch = get_default_branch(repo)
+    if offline:
+        result = subprocess.run(
+            ["git", "merge-base", "HEAD", f"origin/{default_branch}"],
+            check=True,
+            capture_output=True,
+            text=True,
+            cwd=repo)
+        return result.stdout.strip()
+    subprocess.run(["git", "fetch", "origin", default_branch],
+                   check=True,
+                   stdout=subprocess.DEVNULL,
+                   stderr=subprocess.DEVNULL,
+                   cwd=repo)
+    return f"origin/{default_branch}"
+
+
+BASE_HELP = ('Commit to diff against, without fetching. Given as '
+             '<repo path>=<commit> per repo, or as <commit> for a single repo')
 
-        # Fall back to default revision
-        default = root.find("default")
-        if default is not None:
-            return default.get("revision", "main")
 
-    return "main"
+def parse_bases(repos: List[str], values: List[str]) -> Dict[str, str]:
+    """Maps repos to the commits given by --base values. A commit exists in
+    one repo only, so a bare commit is refused for more than one repo.
+    Raises ValueError for values that don't fit `repos`."""
+    repos = [repo.strip() for repo in repos]
+    bases = {}
+    for value in values or []:
+        path, sep, commit = value.rpartition("=")
+        if not sep:
+            if len(repos) > 1:
+                raise ValueError(
+                    f"--base {value} is ambiguous for {len(repos)} repos, "
+                    "use <repo path>=<commit>")
+            bases.update((repo, value) for repo in repos)
+            continue
+        matches = [
+            repo for repo in repos
+            if os.path.realpath(repo) == os.path.realpath(path)
+        ]
+        if not matches:
+            raise ValueError(f"--base {value} names no checked repo")
+        bases.update((repo, commit) for repo in matches)
+    return bases
 
 
-def get_changed_files(repo: str) -> List[str]:
+def get_changed_files(repo: str,
+                      base: str = None,
+                      offline: bool = False) -> List[str]:
     """Get list of modified files in the merge request"""
     try:
-        default_branch = get_default_branch(repo)
-        subprocess.run(["git", "fetch", "origin", default_branch],
-                       check=True,
-                       stdout=subprocess.DEVNULL,
-                       stderr=subprocess.DEVNULL,
-                       cwd=repo)
-
-        result = subprocess.run([
-            "git", "diff", "--name-only", "--diff-filter=ACMR",
-            f"origin/{default_branch}"
-        ],
-                                check=True,
-                                capture_output=True,
-                                text=True,
-                                cwd=repo)
+        diff_base = get_diff_base(repo, base, offline)
+        result = subprocess.run(
+            ["git", "diff", "--name-only", "--diff-filter=ACMR", diff_base],
+            check=True,
+            capture_output=True,
+            text=True,
+            cwd=repo)
         return [f.strip() for f in result.stdout.splitlines() if f.strip()]
     except subprocess.CalledProcessError as e:
         print(f"❌ Failed to get changed files: {e.stderr}")
         raise Exception("Get changed files failed!!!")
 
 
+def get_changed_files_of(repos: List[str],
+                         bases: Dict[str, str] = None,
+                         offline: bool = False) -> Dict[str, List[str]]:
+    """Changed files of each repo, diffed against its commit in `bases` if
+    any, see parse_bases(). The repos are diffed, and fetched if needed,
+    concurrently."""
+    repos = [repo.strip() for repo in repos]
+    bases = bases or {}
+    with ThreadPoolExecutor(max_workers=max(1, len(repos))) as pool:
+        changed = pool.map(
+            lambda r: get_changed_files(r, bases.get(r), offline), repos)
+        return dict(zip(repos, changed))
+
+
+# Files per formatter invocation. Small enough to spread a large merge
+# request over all workers, large enough to amortize process startup.
+MAX_CHUNK_SIZE = 64
+
+FORMAT_JOBS = os.cpu_count() or 1
+
+# Shared by all repos, so that the total number of formatter processes is
+# bounded.
+FORMAT_POOL = ThreadPoolExecutor(max_workers=FORMAT_JOBS)
+
+
+def chunks(files: List[str], workers: int) -> List[List[str]]:
+    size = max(1, min(MAX_CHUNK_SIZE, -(-len(files) // workers)))
+    return [files[i:i + size] for i in range(0, len(files), size)]
+
+
+def run_batched(repo: str, cmd: List[str],
+                files: List[str]) -> List[Tuple[str, str]]:
+    """Runs `cmd` over chunks of files in parallel. A failing chunk is split
+    in halves until each error is attributed to its file, which takes a few
+    runs per failing file instead of one run per file of the chunk.
+    Returns (file, output) of the files that failed."""
+
+    def run(chunk):
+        proc = subprocess.run(cmd + chunk,
+                              capture_output=True,
+                              text=True,
+                              cwd=repo)
+        return chunk, proc
+
+    failed = []
+    pending = chunks(files, FORMAT_JOBS)
+    while pending:
+        bisect = []
+        for chunk, proc in FORMAT_POOL.map(run, pending):
+            if proc.returncode == 0:
+                continue
+            if len(chunk) == 1:
+                failed.append((chunk[0], proc.stdout + proc.stderr))
+                continue
+            half = len(chunk) // 2
+            bisect += [chunk[:half], chunk[half:]]
+        pending = bisect
+    order = {f: i for i, f in enumerate(files)}
+    return sorted(failed, key=lambda x: order[x[0]])
+
+
+def cache_dir() -> str:
+    """Root of the on-disk caches shared by builds and CI runs."""
+    if os.environ.get("BLUEOS_CACHE_DIR"):
+        return os.environ["BLUEOS_CACHE_DIR"]
+    return os.path.join(
+        os.environ.get("XDG_CACHE_HOME", os.path.expanduser("~/.cache")),
+        "blueos")
+
+
+class FormatCache(object):
+    """Files known to be formatted, keyed by git blob hash, formatter
+    command, formatter version and hash of the formatter config. Each clean
+    verdict is an empty file, so concurrent checks can share the cache."""
+
+    def __init__(self, root: str):
+        self.root = root
+
+    @staticmethod
+    def key(blob: str, cmd: List[str], version: str, config: str) -> str:
+        h = hashlib.sha256()
+        for part in [blob, " ".join(cmd), version, config]:
+            h.update(part.encode())
+            h.update(b"\0")
+        return h.hexdigest()
+
+    def path(self, key: str) -> str:
+        return os.path.join(self.root, key[:2], key)
+
+    def is_clean(self, key: str) -> bool:
+        return os.path.exists(self.path(key))
+
+    def record_clean(self, key: str):
+        path = self.path(key)
+        try:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            open(path, "w").close()
+        except OSError:
+            pass
+
+
+FORMAT_CACHE = FormatCache(os.path.join(cache_dir(), "fmt_clean"))
+
+
+def blob_hashes(repo: str, files: List[str]) -> List[str]:
+    """Git blob hashes of the working tree files, in one git process. Paths
+    go to stdin, so any number of them fits."""
+    if not files:
+        return []
+    result = subprocess.run(["git", "hash-object", "--stdin-paths"],
+                            input="".join(f + "\n" for f in files),
+                            check=True,
+                            capture_output=True,
+                            text=True,
+                            cwd=repo)
+    return result.stdout.split()
+
+
+@functools.lru_cache(maxsize=None)
+def formatter_version(tool: str) -> str:
+    try:
+        result = subprocess.run([tool, "--version"],
+                                capture_output=True,
+                                text=True)
+    except FileNotFoundError:
+        return ""
+    return result.stdout + result.stderr
+
+
+def config_hash(repo: str, names: List[str]) -> str:
+    """Hash of the formatter config files in the root of `repo`. Configs
+    in subdirectories aren't considered."""
+    h = hashlib.sha256()
+    for name in names:
+        path = os.path.join(repo, name)
+        if os.path.isfile(path):
+            h.update(name.encode())
+            with open(path, "rb") as f:
+                h.update(f.read())
+    return h.hexdigest()
+
+
+def run_cached(repo: str, cmd: List[str], configs: List[str],
+               files: List[str]) -> List[Tuple[str, str]]:
+    """Like run_batched(), but skips files known clean and records the
+    files found clean."""
+    if not files:
+        return []
+    version = formatter_version(cmd[0])
+    config = config_hash(repo, configs)
+    keys = {
+        f: FORMAT_CACHE.key(blob, cmd, version, config)
+        for f, blob in zip(files, blob_hashes(repo, files))
+    }
+    unknown = [f for f in files if not FORMAT_CACHE.is_clean(keys[f])]
+    failed = run_batched(repo, cmd, unknown)
+    bad = set(f for f, _ in failed)
+    for f in unknown:
+        if f not in bad:
+            FORMAT_CACHE.record_clean(keys[f])
+    return failed
+
+
 def check_files_format(repo: str, files: List[str]) -> List[Tuple[str, str]]:
     """Check formatting for different file types"""
     errors = []
@@ -86,74 +299,67 @@ def check_files_format(repo: str, files: List[str]) -> List[Tuple[str, str]]:
     gn_files = [f for f in files if f.endswith((".gn", ".gni"))]
 
     # Check Rust formatting
-    if rust_files:
-        try:
-            subprocess.run([
-                "rustfmt",
-                "--edition=2021",
-                "--check",
-                "--unstable-features",
-                "--skip-children",
-            ] + rust_files,
-                           check=True,
-                           capture_output=True,
-                           text=True,
-                           cwd=repo)
-        except subprocess.CalledProcessError as e:
-            errors.append(("Rust", e.stdout + e.stderr))
-
-    # Check GN formatting
-    for gn_file in gn_files:
-        try:
-            subprocess.run(["gn", "format", "--dry-run", gn_file],
-                           check=True,
-                           capture_output=True,
-                           text=True,
-                           cwd=repo)
-        except subprocess.CalledProcessError as e:
-            errors.append(("GN", f"{gn_file}: {e.stderr}"))
+    for rust_file, output in run_cached(repo, [
+            "rustfmt",
+            "--edition=2021",
+            "--check",
+            "--unstable-features",
+            "--skip-children",
+    ], ["rustfmt.toml", ".rustfmt.toml"], rust_files):
+        errors.append(("Rust", f"{rust_file}: {output}"))
+
+    # Check GN formatting, which has no config.
+    for gn_file, output in run_cached(repo, ["gn", "format", "--dry-run"], [],
+                                      gn_files):
+        errors.append(("GN", f"{gn_file}: {output}"))
 
     # Check Python formatting with yapf3
-    for py_file in python_files:
-        try:
-            yapf = "yapf3"
-            if platform.system() == "Darwin":
-                yapf = "yapf"
-            subprocess.run([yapf, "-d", py_file],
-                           check=True,
-                           capture_output=True,
-                           text=True,
-                           cwd=repo)
-        except subprocess.CalledProcessError as e:
-            errors.append(("Python", f"{py_file}: {e.stderr}"))
+    yapf = "yapf3"
+    if platform.system() == "Darwin":
+        yapf = "yapf"
+    for py_file, output in run_cached(
+            repo, [yapf, "-d"], [".style.yapf", "setup.cfg", "pyproject.toml"],
+            python_files):
+        errors.append(("Python", f"{py_file}: {output}"))
 
     return errors
 
 
-def check_format(repo_to_check):
+def check_format(repo_to_check, changed_files=None):
+    """Checks the changed files of the repos. `changed_files` maps each repo
+    to its changed files, see get_changed_files_of()."""
     print(f"🔍 Checking format of {repo_to_check} ...")
+    if changed_files is None:
+        changed_files = get_changed_files_of(repo_to_check)
+
+    def check_repo(repo):
+        return check_files_format(repo, changed_files[repo])
+
     format_errors = []
-    for repo in repo_to_check:
-        try:
-            changed_files = get_changed_files(repo.strip())
-        except Exception as e:
-            raise
-        format_errors.extend(check_files_format(repo.strip(), changed_files))
+    repos = [repo.strip() for repo in repo_to_check]
+    with ThreadPoolExecutor(max_workers=max(1, len(repos))) as pool:
+        # Errors are reported in the order of the repos.
+        for errors in pool.map(check_repo, repos):
+            format_errors.extend(errors)
     if format_errors:
-        print("\n❌ Formatting issues found:")
-        for lang, msg in format_errors:
-            print(f"\n===== {lang} Issues =====")
-            print(msg.strip())
-        print("\n🛠️  Fix suggestions:")
-        print("Rust  : Run 'rustfmt [file]'")
-        print("GN    : Run 'gn format [file]'")
-        print("Python: Run 'yapf3 -i [file]'")
-        sys.stdout.flush()
+        print_format_errors(format_errors)
         raise Exception("Format check failed!!!")
     print("✅ All files are properly formatted!")
     sys.stdout.flush()
 
 
+def print_format_errors(format_errors: List[Tuple[str, str]]):
+    print("\n❌ Formatting issues found:")
+    for lang, msg in format_errors:
+        print(f"\n===== {lang} Issues =====")
+        print(msg.strip())
+    print("\n🛠️  Fix suggestions:")
+    print("Rust  : Run 'rustfmt [file]'")
+    print("GN    : Run 'gn format [file]'")
+    print("Python: Run 'yapf3 -i [file]'")
+    sys.stdout.flush()
+
+
 def main():
     # The script lives at <kernel_root>/build/ci/run_check_fmt.py
     kernel_root = str(Path(__file__).resolve().parent.parent.parent)
@@ -167,9 +373,22 @@ def main():
         help=
         'Repository paths to check (default: kernel repo root derived from script location)'
     )
+    parser.add_argument(
+        '--offline',
+        action='store_true',
+        help=
+        'Diff against the merge-base with the local origin/<branch>, without fetching'
+    )
+    parser.add_argument('--base', action='append', help=BASE_HELP)
     args = parser.parse_args()
     try:
-        check_format(args.repo_paths)
+        bases = parse_bases(args.repo_paths, args.base)
+    except ValueError as e:
+        parser.error(str(e))
+    try:
+        check_format(
+            args.repo_paths,
+            get_changed_files_of(args.repo_paths, bases, args.offline))
     except Exception as e:
         sys.exit(1)
 
@@ -18,30 +18,44 @@ import argparse
 import subprocess
 import shutil
 import sys
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
-from typing import List, Tuple
+from typing import Dict, List, Tuple
+from run_check_fmt import BASE_HELP, get_changed_files_of, parse_bases
 
+# Files per license-eye invocation, to stay below the command line limit.
+MAX_FILES_PER_CHECK = 256
 
-def check_repo_license(repo) -> List[Tuple[str, str]]:
+
+def check_repo_license(repo, files: List[str] = None) -> List[Tuple[str, str]]:
     """
     Check if the license header is present in the specified repo.
-    Use repo .license-eye.yaml configuration file
+    Use repo .licenserc.yaml configuration file
+    Only `files` are checked if given, the whole repo otherwise.
     """
     errors = []
     if shutil.which("license-eye"):
-        # for file in files:
-        try:
-            # every repo should first has license-eye configured
-            # so just run use the default configuration
-            result = subprocess.run(["license-eye", "header", "check"],
-                                    capture_output=True,
-                                    text=True,
-                                    cwd=repo)
-            if "don't have a valid license header" in result.stdout or result.returncode != 0:
-                errors.append(
-                    ("License Header:", f"{result.stdout + result.stderr}"))
-        except subprocess.CalledProcessError as e:
-            errors.append(("License Header", f": {e.stdout + e.stderr}"))
+        if files is None:
+            batches = [[]]
+        else:
+            batches = [
+                files[i:i + MAX_FILES_PER_CHECK]
+                for i in range(0, len(files), MAX_FILES_PER_CHECK)
+            ]
+        for batch in batches:
+            try:
+                # every repo should first has license-eye configured
+                # so just run use the default configuration
+                result = subprocess.run(["license-eye", "header", "check"] +
+                                        batch,
+                                        capture_output=True,
+                                        text=True,
+                                        cwd=repo)
+                if "don't have a valid license header" in result.stdout or result.returncode != 0:
+                    errors.append(("License Header:",
+                                   f"{result.stdout + result.stderr}"))
+            except subprocess.CalledProcessError as e:
+                errors.append(("License Header", f": {e.stdout + e.stderr}"))
     else:
         print("❌ license-eye tool not found. Please install it first.")
         print(
@@ -51,23 +65,42 @@ def check_repo_license(repo) -> List[Tuple[str, str]]:
     return errors
 
 
-def check_license(repo_to_check):
+def needs_license(repo) -> bool:
+    if "libc" in repo or "book" in repo or "external" in repo:
+        print(
+            f"Skipping {repo} as it is not a valid repository for license check."
+        )
+        return False
+    return True
+
+
+def print_license_errors(check_errors: List[Tuple[str, str]]):
+    print("\n❌ Licenses issues found:")
+    for _, msg in check_errors:
+        print(f"\n===== License Issues =====")
+        print(msg.strip())
+    print("License Header: Run 'cd repo && license-eye header fix'")
+    sys.stdout.flush()
+
+
+def check_license(repo_to_check, changed_files: Dict[str, List[str]] = None):
+    """Checks the changed files of the repos, see get_changed_files_of(), or
+    whole repos if `changed_files` is None."""
     print(f"🔍 Checking license of {repo_to_check} ...")
+    repos = [repo.strip() for repo in repo_to_check if needs_license(repo)]
+
+    def check_repo(repo):
+        if changed_files is None:
+            return check_repo_license(repo)
+        return check_repo_license(repo, changed_files[repo])
+
     check_errors = []
-    for repo in repo_to_check:
-        if "libc" in repo or "book" in repo or "external" in repo:
-            print(
-                f"Skipping {repo} as it is not a valid repository for license check."
-            )
-            continue
-        check_errors.extend(check_repo_license(repo.strip()))
+    with ThreadPoolExecutor(max_workers=max(1, len(repos))) as pool:
+        # Errors are reported in the order of the repos.
+        for errors in pool.map(check_repo, repos):
+            check_errors.extend(errors)
     if check_errors:
-        print("\n❌ Licenses issues found:")
-        for _, msg in check_errors:
-            print(f"\n===== License Issues =====")
-            print(msg.strip())
-        print("License Header: Run 'cd repo && license-eye header fix'")
-        sys.stdout.flush()
+        print_license_errors(check_errors)
         raise Exception("License check failed!!!")
     print("✅ All repos licenses are checked!")
     sys.stdout.flush()
@@ -85,9 +118,27 @@ def main():
         help=
         'Repository paths to check (default: kernel repo root derived from script location)'
     )
+    parser.add_argument('--full',
+                        action='store_true',
+                        help='Check whole repos instead of changed files')
+    parser.add_argument(
+        '--offline',
+        action='store_true',
+        help=
+        'Diff against the merge-base with the local origin/<branch>, without fetching'
+    )
+    parser.add_argument('--base', action='append', help=BASE_HELP)
     args = parser.parse_args()
     try:
-        check_license(args.repo_paths)
+        bases = parse_bases(args.repo_paths, args.base)
+    except ValueError as e:
+        parser.error(str(e))
+    try:
+        changed_files = None
+        if not args.full:
+            changed_files = get_changed_files_of(args.repo_paths, bases,
+                                                 args.offline)
+        check_license(args.repo_paths, changed_files)
     except Exception as e:
         sys.exit(1)
 
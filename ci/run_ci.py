@@ -30,9 +30,16 @@ import tempfile
 import logging
 import itertools
 import asyncio
+import concurrent.futures
 import platform
-from run_check_fmt import check_format
-from run_check_license import check_license
+import hashlib
+import time
+import threading
+from presubmit import has_failed, run_presubmit, start_presubmit
+from run_check_fmt import BASE_HELP, parse_bases
+from result_cache import BUILD_ROOT, ResultCache, common_fingerprint, hash_file, hash_tree
+from run_journal import RunJournal, PASS, FAIL, CACHED
+from shard import load_durations, partition
 import argparse
 
 # Use these lists to create CI matrix. Done by using itertools.product.
@@ -76,11 +83,43 @@ class Config(object):
         self.direct_syscall_handler = flag
         return self
 
+    def name(self):
+        basename = f'{self.board}.{self.build_type}'
+        if self.direct_syscall_handler:
+            basename += '.dsc'
+        else:
+            basename += '.swi'
+        return basename
+
 
 class Runner(object):
 
-    def __init__(self, config):
+    def __init__(self, config, jobs=None, log_file=None, gate=None):
         self.config = config
+        # Number of ninja jobs, None lets ninja pick its own default.
+        self.jobs = jobs
+        # When set, output of every command is appended to this file rather
+        # than being written to the console.
+        self.log_file = log_file
+        # Future of the presubmit result. The build starts at once, the check
+        # waits for the gate and the runner is cancelled if the gate fails.
+        self.gate = gate
+        self.process = None
+        self.cancelled = False
+        self.lock = threading.Lock()
+        if gate is not None:
+            gate.add_done_callback(self.on_gate_done)
+
+    def on_gate_done(self, gate):
+        if has_failed(gate):
+            self.cancel()
+
+    def cancel(self):
+        '''Stops the running command, no command is started afterwards.'''
+        with self.lock:
+            self.cancelled = True
+            if self.process is not None:
+                self.process.terminate()
 
     def run(self):
         LOGGER.info(
@@ -89,12 +128,7 @@ class Runner(object):
         return self.run_gn_gen_and_ninja()
 
     def outdir_name(self):
-        basename = f'{self.config.board}.{self.config.build_type}'
-        if self.config.direct_syscall_handler:
-            basename += '.dsc'
-        else:
-            basename += '.swi'
-        return os.path.join('out', basename)
+        return os.path.join('out', self.config.name())
 
     def make_gn_args_str(self):
         return ' '.join([
@@ -103,6 +137,50 @@ class Runner(object):
             f"direct_syscall_handler={'true' if self.config.direct_syscall_handler else 'false'}",
         ])
 
+    def fingerprint(self, common):
+        '''
+        Fingerprint of the config on top of `common`, see
+        `result_cache.common_fingerprint`. Returns None if `common` is None.
+        '''
+        if common is None:
+            return None
+        h = hashlib.sha256()
+        h.update(common.encode())
+        h.update(self.make_gn_args_str().encode())
+        boards_dir = os.path.join(BUILD_ROOT, 'boards')
+        hash_file(h, os.path.join(boards_dir, f'{self.config.board}.gni'),
+                  f'{self.config.board}.gni')
+        hash_tree(h, os.path.join(boards_dir, self.config.board))
+        return h.hexdigest()
+
+    def wait(self, cmd, **kwargs):
+        # The process is stored, so that `cancel` can terminate it.
+        with self.lock:
+            if self.cancelled:
+                return -1
+            self.process = subprocess.Popen(cmd, **kwargs)
+        try:
+            return self.process.wait()
+        except BaseException:
+            self.process.kill()
+            raise
+        finally:
+            with self.lock:
+                self.process = None
+
+    def call(self, cmd):
+        if self.log_file is None:
+            return self.wait(cmd)
+        with open(self.log_file, 'a') as log:
+            log.write(f'$ {shlex.join(cmd)}\n')
+            log.flush()
+            # QEMU must not grab the terminal of the CI runner when several
+            # configs are running at the same time.
+            return self.wait(cmd,
+                             stdin=subprocess.DEVNULL,
+                             stdout=log,
+                             stderr=subprocess.STDOUT)
+
     def run_gn_gen(self):
         args = self.make_gn_args_str()
         cmd = [
@@ -111,54 +189,173 @@ class Runner(object):
             self.outdir_name(),
             f"--args={args}",
         ]
-        return subprocess.call(cmd)
+        return self.call(cmd)
 
-    def ninja_default(self):
+    def ninja(self, target):
         cmd = [
             'ninja',
             '-C',
             self.outdir_name(),
-            'default',
         ]
-        return subprocess.call(cmd)
+        if self.jobs:
+            cmd += ['-j', str(self.jobs)]
+        cmd.append(target)
+        return self.call(cmd)
+
+    def ninja_default(self):
+        return self.ninja('default')
 
     def ninja_check(self):
-        cmd = [
-            'ninja',
-            '-C',
-            self.outdir_name(),
-            'check_all',
-        ]
-        return subprocess.call(cmd)
+        return self.ninja('check_all')
 
     def ninja_test(self):
-        cmd = [
-            'ninja',
-            '-C',
-            self.outdir_name(),
-            'test',
-        ]
-        return subprocess.call(cmd)
+        return self.ninja('test')
 
     def ninja_check_coverage(self):
-        cmd = [
-            'ninja',
-            '-C',
-            self.outdir_name(),
-            'check_coverage',
-        ]
-        return subprocess.call(cmd)
+        return self.ninja('check_coverage')
 
-    def run_gn_gen_and_ninja(self):
+    def run_build(self):
         rc = self.run_gn_gen()
         if rc != 0:
             return rc
+        if self.config.build_type == 'coverage':
+            # Coverage builds are driven by the check target only.
+            return 0
+        return self.ninja_default()
+
+    def run_check(self):
         if self.config.build_type == 'coverage':
             return self.ninja_check_coverage()
-        rc = self.ninja_default()
+        return self.ninja_check()
+
+    def passed_gate(self):
+        '''Waits for the presubmit gate, returns whether it has passed.'''
+        if self.gate is None:
+            return True
+        concurrent.futures.wait([self.gate])
+        return not has_failed(self.gate)
+
+    def run_gn_gen_and_ninja(self):
+        rc = self.run_build()
         if rc != 0:
             return rc
-        return self.ninja_check()
+        if not self.passed_gate():
+            return -1
+        return self.run_check()
+
+
+class Scheduler(object):
+    '''
+    Runs the build and check steps of many configs concurrently.
+    At most `parallel` configs are building at the same time, and the QEMU
+    bound check steps are limited separately by `check_parallel`. Check
+    steps run ninja too, e.g. to compile test images, so the global `jobs`
+    budget is split evenly between the ninja processes of both.
+    Output of each config goes to its own file in `log_dir`.
+    With a presubmit `gate`, configs are built while the presubmit checks
+    run. They are checked once the gate passed and cancelled if it fails.
+    '''
+
+    def __init__(self,
+                 configs,
+                 parallel,
+                 jobs,
+                 check_parallel,
+                 log_dir,
+                 keep_going=False,
+                 on_done=None,
+                 gate=None):
+        self.configs = configs
+        self.parallel = max(1, parallel)
+        self.check_parallel = max(1, check_parallel)
+        self.jobs_per_config = max(
+            1, jobs // (self.parallel + self.check_parallel))
+        self.log_dir = log_dir
+        # Whether to keep scheduling configs after a failure.
+        self.keep_going = keep_going
+        # Called with (config, rc, duration) once a config has finished.
+        self.on_done = on_done
+        self.gate = gate
+        self.failed = False
+
+    def log_file(self, config):
+        return os.path.join(self.log_dir, f'{config.name()}.log')
+
+    def report(self, config, msg):
+        print(f'[{config.name()}] {msg}')
+        sys.stdout.flush()
+
+    def should_stop(self):
+        if has_failed(self.gate):
+            return True
+        return self.failed and not self.keep_going
+
+    async def run_config(self, config, build_sem, check_sem):
+        # Time spent waiting for a slot isn't counted in the duration.
+        duration = 0
+        async with build_sem:
+            if self.should_stop():
+                return None
+            log_file = self.log_file(config)
+            if os.path.exists(log_file):
+                os.unlink(log_file)
+            runner = Runner(config,
+                            jobs=self.jobs_per_config,
+                            log_file=log_file,
+                            gate=self.gate)
+            self.report(config, f'building, log: {log_file}')
+            start = time.monotonic()
+            rc = await asyncio.to_thread(runner.run_build)
+            duration += time.monotonic() - start
+        if rc == 0 and self.gate is not None:
+            # Wait for the gate without holding a worker thread.
+            await asyncio.wait([asyncio.wrap_future(self.gate)])
+            if has_failed(self.gate):
+                runner.cancel()
+        if runner.cancelled:
+            self.report(config, 'cancelled')
+            return None
+        if rc == 0:
+            async with check_sem:
+                if self.should_stop():
+                    return None
+                self.report(config, 'checking')
+                start = time.monotonic()
+                rc = await asyncio.to_thread(runner.run_check)
+                duration += time.monotonic() - start
+        if runner.cancelled:
+            self.report(config, 'cancelled')
+            return None
+        if rc != 0:
+            self.failed = True
+            self.report(config, f'failed with {rc}, see {log_file}')
+        else:
+            self.report(config, 'passed')
+        if self.on_done:
+            self.on_done(config, rc, duration)
+        return rc
+
+    async def go(self):
+        # Every running step occupies a worker thread while waiting for its
+        # subprocess.
+        asyncio.get_running_loop().set_default_executor(
+            concurrent.futures.ThreadPoolExecutor(max_workers=self.parallel +
+                                                  self.check_parallel))
+        build_sem = asyncio.Semaphore(self.parallel)
+        check_sem = asyncio.Semaphore(self.check_parallel)
+        return await asyncio.gather(*[
+            self.run_config(config, build_sem, check_sem)
+            for config in self.configs
+        ])
+
+    def run(self):
+        os.makedirs(self.log_dir, exist_ok=True)
+        failed_rc = 0
+        for config, rc in zip(self.configs, asyncio.run(self.go())):
+            if rc:
+                LOGGER.error(f'Failed to run with {config.name()}')
+                failed_rc = failed_rc or rc
+        return failed_rc
 
 
 # After running qemu, tty's echo becomes unfunctional. Let's recover it.
@@ -185,39 +382,181 @@ def main():
                         action='store_true',
                         default=False,
                         help='Setup output directories of boards only')
+    parser.add_argument(
+        '--parallel',
+        type=int,
+        default=1,
+        help='Number of configs to build concurrently. 1 runs them serially')
+    parser.add_argument(
+        '--jobs',
+        type=int,
+        default=os.cpu_count() or 1,
+        help='Global ninja job budget, split between concurrent configs')
+    parser.add_argument(
+        '--check_parallel',
+        type=int,
+        default=1,
+        help='Number of QEMU bound `check_all` steps to run concurrently')
+    parser.add_argument(
+        '--log_dir',
+        default=os.path.join('out', 'logs'),
+        help='Directory of per config logs when running in parallel')
+    parser.add_argument('--cache_dir',
+                        default=os.path.join('out', '.ci_cache'),
+                        help='Directory of the result cache of passed configs')
+    parser.add_argument(
+        '--force',
+        action='store_true',
+        default=False,
+        help='Run all configs even if they have a recorded pass in the cache')
+    parser.add_argument('--journal',
+                        default=os.path.join('out', '.ci_journal.json'),
+                        help='File recording the outcome of each config')
+    parser.add_argument(
+        '--resume',
+        action='store_true',
+        default=False,
+        help='Only run configs which failed or never ran in the journal')
+    parser.add_argument(
+        '--keep_going',
+        action='store_true',
+        default=False,
+        help='Run the whole matrix instead of stopping at the first failure')
+    parser.add_argument('--shard_index',
+                        type=int,
+                        default=0,
+                        help='Index of the shard of the matrix to run')
+    parser.add_argument('--shard_count',
+                        type=int,
+                        default=1,
+                        help='Number of shards the matrix is split into')
+    parser.add_argument(
+        '--durations',
+        help=
+        'Report or journal of a previous run used to balance the shards. It must be the same file on all shards'
+    )
+    parser.add_argument(
+        '--offline',
+        action='store_true',
+        default=False,
+        help=
+        'Diff repos against the merge-base with the local origin/<branch>, without fetching'
+    )
+    parser.add_argument('--base', action='append', help=BASE_HELP)
+    parser.add_argument(
+        '--full_license_check',
+        action='store_true',
+        default=False,
+        help='Check license headers of whole repos instead of changed files')
+    parser.add_argument(
+        '--speculative_build',
+        action='store_true',
+        default=False,
+        help=
+        'Start building while the presubmit checks run, cancel the builds if they fail'
+    )
     parser.add_argument('repo_paths',
                         nargs='*',
                         help='Repository paths to check')
 
     args = parser.parse_args()
     repo_to_check = args.repo_paths
+    if not 0 <= args.shard_index < args.shard_count:
+        parser.error('--shard_index must be in [0, --shard_count)')
 
     try:
-        check_format(repo_to_check)
-        # stage 2: check license
-        check_license(repo_to_check)
-    except Exception as e:
-        LOGGER.error(f"Formatting check failed: {e}")
+        bases = parse_bases(repo_to_check, args.base)
+    except ValueError as e:
+        parser.error(str(e))
+    presubmit_args = (repo_to_check, bases, args.offline,
+                      args.full_license_check)
+    gate = None
+    if args.speculative_build and not args.setup_only:
+        gate = start_presubmit(*presubmit_args)
+    elif not run_presubmit(*presubmit_args):
+        LOGGER.error('Presubmit checks failed')
         return -1
     try:
         build_types_to_test = [args.build_type
                                ] if args.build_type else BUILD_TYPES
         boards_to_test = [args.board] if args.board else BOARDS
+        configs = []
         for profile in itertools.product(build_types_to_test, boards_to_test,
                                          DIRECT_SYSCALL_HANDLER_FLAGS):
-            config = Config().set_build_type(profile[0]).set_board(
-                profile[1]).set_direct_syscall_handler(profile[2])
-            if args.setup_only:
+            configs.append(Config().set_build_type(profile[0]).set_board(
+                profile[1]).set_direct_syscall_handler(profile[2]))
+        if args.shard_count > 1:
+            configs = partition(configs, load_durations(args.durations),
+                                args.shard_count)[args.shard_index]
+            print(f'Shard {args.shard_index}/{args.shard_count}: ' +
+                  ', '.join(config.name() for config in configs))
+        if args.setup_only:
+            for config in configs:
                 rc = Runner(config).run_gn_gen()
                 if rc != 0:
-                    LOGGER.error(f'Failed to setup with {profile}')
+                    LOGGER.error(f'Failed to setup with {config.name()}')
                     return rc
+            return 0
+
+        journal = RunJournal(args.journal)
+        if args.resume:
+            journal.load()
+        else:
+            journal.save()
+        cache = ResultCache(args.cache_dir)
+        common = common_fingerprint(repo_to_check)
+        fingerprints = {}
+        pending = []
+        for config in configs:
+            if args.resume and journal.has_passed(config):
                 continue
-            rc = Runner(config).run()
-            if rc != 0:
-                LOGGER.error(f'Failed to run with {profile}')
-                return rc
-        return 0
+            fingerprints[config.name()] = Runner(config).fingerprint(common)
+            if args.force:
+                pending.append(config)
+            elif not cache.lookup(config, fingerprints[config.name()]):
+                pending.append(config)
+            else:
+                journal.record(config, CACHED, 0)
+        if not args.force:
+            cache.report()
+
+        def on_done(config, rc, duration):
+            if rc == 0:
+                cache.record_pass(config, fingerprints[config.name()])
+                journal.record(config, PASS, duration)
+            else:
+                journal.record(config, FAIL, duration, rc)
+
+        if args.parallel > 1:
+            failed_rc = Scheduler(pending,
+                                  args.parallel,
+                                  args.jobs,
+                                  args.check_parallel,
+                                  args.log_dir,
+                                  keep_going=args.keep_going,
+                                  on_done=on_done,
+                                  gate=gate).run()
+        else:
+            failed_rc = 0
+            for config in pending:
+                runner = Runner(config, gate=gate)
+                start = time.monotonic()
+                rc = runner.run()
+                if runner.cancelled:
+                    break
+                on_done(config, rc, time.monotonic() - start)
+                if rc != 0:
+                    LOGGER.error(f'Failed to run with {config.name()}')
+                    failed_rc = failed_rc or rc
+                    if not args.keep_going:
+                        break
+        journal.print_summary(configs)
+        if gate is not None:
+            concurrent.futures.wait([gate])
+            if has_failed(gate):
+                LOGGER.error('Presubmit checks failed')
+                return -1
+        return failed_rc
     finally:
         recover_tty_echo()
 
@@ -0,0 +1,83 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# Copyright (c) 2025 vivo Mobile Communication Co., Ltd.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+'''
+Persisted journal of a CI run. Outcome and duration of every config are
+written as soon as the config finishes, so that an interrupted or failed
+run can be resumed by running only what failed or never ran.
+'''
+
+import os
+import json
+import sys
+
+PASS = 'pass'
+FAIL = 'fail'
+CACHED = 'cached'
+NOT_RUN = 'not run'
+
+
+class RunJournal(object):
+
+    def __init__(self, path):
+        self.path = path
+        self.entries = {}
+
+    def load(self):
+        if os.path.exists(self.path):
+            with open(self.path) as f:
+                self.entries = json.load(f)
+        return self
+
+    def save(self):
+        dirname = os.path.dirname(self.path)
+        if dirname:
+            os.makedirs(dirname, exist_ok=True)
+        tmp = f'{self.path}.tmp'
+        with open(tmp, 'w') as f:
+            json.dump(self.entries, f, indent=2, sort_keys=True)
+        os.replace(tmp, self.path)
+
+    def record(self, config, status, duration, rc=0):
+        self.entries[config.name()] = {
+            'status': status,
+            'rc': rc,
+            'duration': round(duration, 3),
+        }
+        self.save()
+
+    def status(self, config):
+        entry = self.entries.get(config.name())
+        if entry is None:
+            return NOT_RUN
+        return entry['status']
+
+    def has_passed(self, config):
+        return self.status(config) in (PASS, CACHED)
+
+    def print_summary(self, configs):
+        rows = []
+        for config in configs:
+            entry = self.entries.get(config.name(), {})
+            duration = entry.get('duration')
+            rows.append((config.name(), self.status(config),
+                         '-' if duration is None else f'{duration:.1f}s'))
+        width = max([len('Config')] + [len(row[0]) for row in rows])
+        print(f"\n{'Config':<{width}}  {'Status':<8}  Time")
+        for name, status, duration in rows:
+            print(f'{name:<{width}}  {status:<8}  {duration}')
+        passed = sum(1 for row in rows if row[1] in (PASS, CACHED))
+        print(f'{passed}/{len(rows)} config(s) passed')
+        sys.stdout.flush()
@@ -0,0 +1,100 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# Copyright (c) 2025 vivo Mobile Communication Co., Ltd.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+'''
+Splits the CI matrix into shards of about the same duration and merges the
+journals of the shards into one report.
+Every shard must compute the same partition, so durations are only taken
+from a file shared by all shards, e.g. the merged report of a previous run.
+'''
+
+import os
+import sys
+import json
+import argparse
+import statistics
+from run_journal import RunJournal, PASS, FAIL
+
+
+def load_durations(path):
+    '''
+    Returns durations of configs which have actually run in `path`.
+    A missing file, e.g. on the first run of a fresh runner, has none.
+    '''
+    durations = {}
+    if not path or not os.path.exists(path):
+        return durations
+    with open(path) as f:
+        entries = json.load(f)
+    for name, entry in entries.items():
+        if entry.get('status') in (PASS, FAIL) and entry.get('duration'):
+            durations[name] = entry['duration']
+    return durations
+
+
+def partition(configs, durations, shard_count):
+    '''
+    Greedily assigns the longest config to the least loaded shard.
+    Configs without a recorded duration are assumed to take the median time.
+    The result only depends on the arguments, so shards on different machines
+    agree on it.
+    '''
+    default = statistics.median(durations.values()) if durations else 1.0
+    weighted = sorted(configs,
+                      key=lambda c:
+                      (-durations.get(c.name(), default), c.name()))
+    shards = [[] for _ in range(shard_count)]
+    loads = [0.0] * shard_count
+    for config in weighted:
+        index = min(range(shard_count), key=lambda i: (loads[i], i))
+        shards[index].append(config)
+        loads[index] += durations.get(config.name(), default)
+    # Keep the matrix order within a shard.
+    order = {config.name(): i for i, config in enumerate(configs)}
+    for shard in shards:
+        shard.sort(key=lambda c: order[c.name()])
+    return shards
+
+
+def merge_reports(output, inputs):
+    merged = RunJournal(output)
+    for path in inputs:
+        merged.entries.update(RunJournal(path).load().entries)
+    merged.save()
+    return merged
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Merge journals of CI shards into one report')
+    parser.add_argument('-o',
+                        '--output',
+                        required=True,
+                        help='The merged report')
+    parser.add_argument('journals', nargs='+', help='Journals of the shards')
+    args = parser.parse_args()
+    merged = merge_reports(args.output, args.journals)
+    failed = [
+        name for name, entry in sorted(merged.entries.items())
+        if entry['status'] == FAIL
+    ]
+    print(f'Merged {len(merged.entries)} config(s) into {args.output}')
+    for name in failed:
+        print(f'❌ {name}')
+    return 1 if failed else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -4,6 +4,7 @@
 """Helper functions useful when writing scripts used by action() targets."""
 import contextlib
 import filecmp
+import hashlib
 import os
 import pathlib
 import posixpath
@@ -13,6 +14,75 @@ from typing import Optional
 from typing import Sequence
 
 
+def _digest_path(path):
+    return os.path.join(os.path.dirname(path),
+                        '.' + os.path.basename(path) + '.digest')
+
+
+def file_digest(path):
+    """Returns the blake2b hex digest of a file, read in chunks."""
+    h = hashlib.blake2b()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 20), b''):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+def read_digest(path):
+    """Returns the digest recorded for `path` by write_digest().
+  Returns None if there is none, or if the file changed since, judged by its
+  size and mtime.
+  """
+    try:
+        with open(_digest_path(path)) as f:
+            size, mtime_ns, digest = f.read().split()
+        st = os.stat(path)
+    except (OSError, ValueError):
+        return None
+    if int(size) != st.st_size or int(mtime_ns) != st.st_mtime_ns:
+        return None
+    return digest
+
+
+def write_digest(path, digest):
+    """Records the digest of `path` in a sidecar file next to it."""
+    st = os.stat(path)
+    sidecar = _digest_path(path)
+    tmp = '%s.%d.tmp' % (sidecar, os.getpid())
+    with open(tmp, 'w') as f:
+        f.write('%d %d %s\n' % (st.st_size, st.st_mtime_ns, digest))
+    os.replace(tmp, sidecar)
+
+
+def write_output_if_changed(path, data, digest=None):
+    """Writes `data` to `path` atomically, unless it already has that content.
+  The content of `path` is known from its sidecar digest, so an unchanged
+  output costs one hash of `data` and no disk write. Without a sidecar the
+  existing file is hashed once.
+  Args:
+    path: Path to the output file.
+    data: The new content (bytes).
+    digest: blake2b hex digest of `data`, if the caller has it already.
+  Returns:
+    Whether the file was written.
+  """
+    if digest is None:
+        digest = hashlib.blake2b(data).hexdigest()
+    recorded = read_digest(path)
+    current = recorded
+    if current is None and os.path.isfile(path) and os.path.getsize(
+            path) == len(data):
+        current = file_digest(path)
+    written = current != digest
+    if written:
+        with atomic_output(path, only_if_changed=False) as f:
+            f.write(data)
+    # The sidecar is only written when it is missing, stale or outdated.
+    if written or recorded != digest:
+        write_digest(path, digest)
+    return written
+
+
 @contextlib.contextmanager
 def atomic_output(path, mode='w+b', encoding=None, only_if_changed=True):
     """Prevent half-written files and dirty mtimes for unchanged files.
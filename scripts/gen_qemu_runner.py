@@ -18,26 +18,62 @@ import os
 import sys
 import argparse
 
+# Block images are created sparse, which costs no disk I/O. dd is used as
+# truncate is missing on macOS. Sizes are in MiB. qemu_checker sets
+# QEMU_BLOCK_IMG to a path in the test directory, so that concurrent runs
+# don't share the image.
 GEN_BLOCK_IMG = r"""
-rm -f {block_img}
-dd if=/dev/zero of={block_img} bs=1M count={block_size}
+BLOCK_IMG="${{QEMU_BLOCK_IMG:-{block_img}}}"
+rm -f "$BLOCK_IMG"
+dd if=/dev/zero of="$BLOCK_IMG" bs=1048576 count=0 seek={block_size} 2>/dev/null
+"""
+
+# Snapshot overlays are based on a pristine image which QEMU never writes.
+GEN_BLOCK_TEMPLATE = r"""
+dd if=/dev/zero of={block_template} bs=1048576 count=0 seek={block_size} 2>/dev/null
+"""
+
+# Used by qemu_checker to boot once to a marker line, save a snapshot there
+# and start later runs from it. All writable drives must be qcow2 for
+# `savevm`, so the block image gets a qcow2 overlay, which is also where the
+# VM state is stored. Without a block image a small VM state drive is added.
+SNAPSHOT = r"""
+SNAPSHOT_ARGS=""
+if [ -n "$QEMU_SNAPSHOT_DRIVE" ]; then
+  if [ ! -f "$QEMU_SNAPSHOT_DRIVE" ]; then
+    {qemu_img} create -q -f qcow2 {backing_args} "$QEMU_SNAPSHOT_DRIVE" {size}
+  fi
+  SNAPSHOT_ARGS="-monitor unix:$QEMU_MONITOR,server,nowait {vmstate_drive}"
+  if [ -n "$QEMU_LOADVM" ]; then
+    SNAPSHOT_ARGS="$SNAPSHOT_ARGS -loadvm $QEMU_LOADVM"
+  fi
+fi
+"""
+
+# qemu_checker sets QEMU_TRACE_LOG to watch the guest for reset loops and
+# guest error storms.
+TRACE = r"""
+TRACE_ARGS=""
+if [ -n "$QEMU_TRACE_LOG" ]; then
+  TRACE_ARGS="-d cpu_reset,guest_errors -D $QEMU_TRACE_LOG"
+fi
 """
 
 TEST = r"""
-exec {qemu} {semihosting} -M {machine} {qemu_args} {block_args} {net_args} -kernel {image} -nographic -serial \
+exec {qemu} {semihosting} -M {machine} {qemu_args} {block_args} {net_args} {snapshot_args} -kernel {image} -nographic -serial \
        file:{logfile} -d int,cpu_reset,guest_errors,unimp -D {syslog}
 """
 
 DBG = r"""
-exec {qemu} {semihosting} -M {machine} {qemu_args} {block_args} {net_args} -kernel {image} -nographic -s -S
+exec {qemu} {semihosting} -M {machine} {qemu_args} {block_args} {net_args} {snapshot_args} -kernel {image} -nographic -s -S
 """
 
 DEFAULT = r"""
-exec {qemu} {semihosting} -M {machine} {qemu_args} {block_args} {net_args} -kernel {image} -nographic
+exec {qemu} {semihosting} -M {machine} {qemu_args} {block_args} {net_args} {snapshot_args} {trace_args} -kernel {image} -nographic
 """
 
 
-def do_gen(config, template, suffix='', need_log=False):
+def do_gen(config, template, suffix='', need_log=False, trace=False):
     out_file = os.path.join(config.out_dir, f'{config.name}-qemu{suffix}.sh')
     logfile = None
     if need_log:
@@ -51,16 +87,52 @@ def do_gen(config, template, suffix='', need_log=False):
 
         block_args = ''
         if config.block_img:
-            dirname = os.path.dirname(config.block_img)
-            os.makedirs(dirname, exist_ok=True)
+            block_img = os.path.abspath(config.block_img)
+            os.makedirs(os.path.dirname(block_img), exist_ok=True)
             f.write(
-                GEN_BLOCK_IMG.format(block_img=config.block_img,
+                GEN_BLOCK_IMG.format(block_img=block_img,
                                      block_size=config.block_size))
-            block_args += f'-drive file={config.block_img},if=none,format=raw,id=hd'
+            if config.snapshot:
+                f.write(
+                    'BLOCK_DRIVE="file=$BLOCK_IMG,format=raw"\n'
+                    'if [ -n "$QEMU_SNAPSHOT_DRIVE" ]; then\n'
+                    '  BLOCK_DRIVE="file=$QEMU_SNAPSHOT_DRIVE,format=qcow2"\n'
+                    'fi\n')
+                block_args += '-drive $BLOCK_DRIVE,if=none,id=hd'
+            else:
+                block_args += '-drive file=$BLOCK_IMG,if=none,format=raw,id=hd'
+
+        snapshot_args = ''
+        if config.snapshot:
+            if config.block_img:
+                block_template = f'{block_img}.template'
+                f.write(
+                    GEN_BLOCK_TEMPLATE.format(block_template=block_template,
+                                              block_size=config.block_size))
+                f.write(
+                    SNAPSHOT.format(qemu_img=config.qemu_img,
+                                    backing_args=f'-b {block_template} -F raw',
+                                    size='',
+                                    vmstate_drive=''))
+            else:
+                f.write(
+                    SNAPSHOT.format(
+                        qemu_img=config.qemu_img,
+                        backing_args='',
+                        size='1M',
+                        vmstate_drive=
+                        '-drive if=none,id=vmstate,format=qcow2,file=$QEMU_SNAPSHOT_DRIVE'
+                    ))
+            snapshot_args = '$SNAPSHOT_ARGS'
 
         if config.block_args:
             block_args += ' ' + config.block_args
 
+        trace_args = ''
+        if trace:
+            f.write(TRACE)
+            trace_args = '$TRACE_ARGS'
+
         if not need_log:
             f.write(
                 template.format(
@@ -72,6 +144,8 @@ def do_gen(config, template, suffix='', need_log=False):
                     if not config.qemu_args != "" else config.qemu_args,
                     block_args=block_args,
                     net_args='' if not config.net_args else config.net_args,
+                    snapshot_args=snapshot_args,
+                    trace_args=trace_args,
                     image=os.path.abspath(config.image)))
         else:
             f.write(
@@ -84,6 +158,7 @@ def do_gen(config, template, suffix='', need_log=False):
                     if config.qemu_args != "" else config.qemu_args,
                     block_args=block_args,
                     net_args='' if not config.net_args else config.net_args,
+                    snapshot_args=snapshot_args,
                     logfile=logfile,
                     syslog=syslog,
                     image=os.path.abspath(config.image)))
@@ -94,7 +169,7 @@ def do_gen(config, template, suffix='', need_log=False):
 def gen(config):
     do_gen(config, TEST, suffix='-test', need_log=True)
     do_gen(config, DBG, suffix='-dbg')
-    do_gen(config, DEFAULT)
+    do_gen(config, DEFAULT, trace=True)
 
 
 def main():
@@ -123,6 +198,13 @@ def main():
                         help="Enable semihosting",
                         action='store_true',
                         default=False)
+    parser.add_argument("--snapshot",
+                        help="Support starting from a snapshot",
+                        action='store_true',
+                        default=False)
+    parser.add_argument("--qemu_img",
+                        help="Executable of qemu-img",
+                        default="qemu-img")
     parser.add_argument("image", help="Image file path")
     config = parser.parse_args()
     return gen(config)
@@ -0,0 +1,153 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# Copyright (c) 2025 vivo Mobile Communication Co., Ltd.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+'''
+Benchmarks boot latency and serial throughput of a QEMU runner script.
+The test image is run K times with the rules of a check file. Time to the
+first line, time to each CHECK-SUCC/ASSERT-SUCC marker and serial bytes per
+second are reported as median and p95, and compared against a baseline.
+'''
+
+import os
+import sys
+import json
+import math
+import logging
+import argparse
+import statistics
+from qemu_checker import Checker, DirectiveParser
+
+LOGGER = logging.getLogger(__name__)
+LOGGER.setLevel(logging.INFO)
+
+FIRST_OUTPUT = 'time_to_first_output'
+THROUGHPUT = 'bytes_per_sec'
+
+
+def run_once(config, index):
+    test_dir = os.path.join(config.t, f'run{index}')
+    checker = Checker(config.s, test_dir)
+    checker.set_log_file(os.path.join(test_dir, 'qemu_checker.log'))
+    DirectiveParser(checker).parse(config.check_file)
+    if checker.run_and_check() != 0:
+        LOGGER.error(f'Run {index} failed, see {checker.log_file}')
+        return None
+    results = checker.results()
+    samples = {FIRST_OUTPUT: results['time_to_first_output']}
+    if results['wall_time']:
+        samples[THROUGHPUT] = results['output_bytes'] / results['wall_time']
+    # Only the first hit of every marker is interesting.
+    for match in results['matches']:
+        if match['directive'] in ('CHECK-SUCC', 'ASSERT-SUCC'):
+            key = f"{match['directive']}: {match['pattern']}"
+            samples.setdefault(key, match['time'])
+    return samples
+
+
+def percentile(values, p):
+    values = sorted(values)
+    return values[max(0, math.ceil(p / 100 * len(values)) - 1)]
+
+
+def summarize(runs):
+    summary = {}
+    for key in sorted(set(k for run in runs for k in run)):
+        values = [run[key] for run in runs if run.get(key) is not None]
+        if not values:
+            continue
+        summary[key] = {
+            'median': statistics.median(values),
+            'p95': percentile(values, 95),
+            'samples': len(values),
+        }
+    return summary
+
+
+def compare(summary, baseline, threshold):
+    '''Returns the metrics whose median regressed by more than threshold.'''
+    regressions = []
+    for key, base in baseline.items():
+        if key not in summary:
+            continue
+        current = summary[key]['median']
+        if key == THROUGHPUT:
+            regressed = current < base['median'] * (1 - threshold)
+        else:
+            regressed = current > base['median'] * (1 + threshold)
+        if regressed:
+            regressions.append((key, base['median'], current))
+    return regressions
+
+
+def print_summary(summary, baseline):
+    width = max([len('Metric')] + [len(key) for key in summary])
+    print(
+        f"{'Metric':<{width}}  {'median':>12}  {'p95':>12}  {'baseline':>12}")
+    for key, value in summary.items():
+        base = baseline.get(key, {}).get('median')
+        base = '-' if base is None else f'{base:.4f}'
+        print(f"{key:<{width}}  {value['median']:>12.4f}  "
+              f"{value['p95']:>12.4f}  {base:>12}")
+    sys.stdout.flush()
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Benchmark boot latency and serial throughput of QEMU')
+    parser.add_argument('-s', help='The qemu runner script', required=True)
+    parser.add_argument('-t', help='The test directory', required=True)
+    parser.add_argument('-k',
+                        '--runs',
+                        type=int,
+                        default=5,
+                        help='Number of times to run the image')
+    parser.add_argument('--baseline', help='Baseline JSON to compare with')
+    parser.add_argument('--save-baseline',
+                        help='Write the summary of this run as a baseline')
+    parser.add_argument(
+        '--threshold',
+        type=float,
+        default=0.1,
+        help='Relative change of a median counted as regression')
+    parser.add_argument('check_file', help='File containing check directives')
+    config = parser.parse_args()
+
+    runs = []
+    for i in range(config.runs):
+        samples = run_once(config, i)
+        if samples is None:
+            return -1
+        runs.append(samples)
+    summary = summarize(runs)
+
+    baseline = {}
+    if config.baseline:
+        with open(config.baseline) as f:
+            baseline = json.load(f)
+    print_summary(summary, baseline)
+    if config.save_baseline:
+        with open(config.save_baseline, 'w') as f:
+            json.dump(summary, f, indent=2)
+
+    regressions = compare(summary, baseline, config.threshold)
+    for key, base, current in regressions:
+        print(f'❌ {key} regressed: {base:.4f} -> {current:.4f}')
+    if regressions:
+        return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
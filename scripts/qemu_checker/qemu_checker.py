@@ -19,11 +19,18 @@ import sys
 import re
 import subprocess
 import shlex
+import signal
 import shutil
 import tempfile
 import logging
 import argparse
 import asyncio
+import json
+import time
+import fcntl
+import hashlib
+import functools
+import collections
 
 LOGGER = logging.getLogger(__name__)
 LOGGER.setLevel(logging.INFO)
@@ -35,6 +42,87 @@ class Rule(object):
         self.pattern = pattern
         self.action = action
         self.priority = priority
+        # Compiled by Checker.prepare().
+        self.bytes_pattern = None
+
+
+# Backreferences would refer to the wrong group once patterns are combined.
+BACKREFERENCE = re.compile(r'\\[1-9]|\(\?P=')
+
+
+# Patterns are compiled once per process, tests sharing rules, e.g. from an
+# included file, share the compiled patterns in batch mode.
+@functools.lru_cache(maxsize=None)
+def to_bytes_pattern(pattern):
+    '''
+    Serial output is matched as bytes, without decoding every line. Note
+    that classes like \\d and \\w only match ASCII in bytes patterns.
+    '''
+    return re.compile(pattern.pattern.encode(), pattern.flags & ~re.UNICODE)
+
+
+def combine_rules(rules):
+    '''
+    Combines the patterns of all rules into one alternation. A line which
+    matches none of the rules, by far the most common case, then costs one
+    scan instead of one scan per rule.
+    Returns None if the patterns can't be combined safely.
+    '''
+    return combine_patterns(tuple(rule.pattern for rule in rules))
+
+
+@functools.lru_cache(maxsize=None)
+def combine_patterns(patterns):
+    if not patterns:
+        return None
+    alternatives = []
+    for pattern in patterns:
+        if BACKREFERENCE.search(pattern.pattern):
+            return None
+        if pattern.flags & ~re.UNICODE:
+            return None
+        alternatives.append(f'(?:{pattern.pattern})')
+    try:
+        return re.compile('|'.join(alternatives).encode())
+    except re.error:
+        return None
+
+
+class LineSplitter(object):
+    '''
+    Splits chunks of output into lines, keeping an incomplete line in a
+    reusable buffer until its newline arrives. Lines longer than `max_len`
+    are cut, so that garbage without newlines can't grow the buffer forever.
+    '''
+
+    def __init__(self, max_len):
+        self.buf = bytearray()
+        self.max_len = max_len
+
+    def feed(self, chunk):
+        buf = self.buf
+        buf += chunk
+        end = buf.rfind(b'\n')
+        if end < 0:
+            if len(buf) < self.max_len:
+                return []
+            return [self.flush_one()]
+        # Only b'\n' ends a line, like readline(), not a lone b'\r' etc.
+        lines = [line + b'\n' for line in bytes(buf[:end]).split(b'\n')]
+        del buf[:end + 1]
+        if len(buf) >= self.max_len:
+            lines.append(self.flush_one())
+        return lines
+
+    def flush_one(self):
+        line = bytes(self.buf)
+        self.buf.clear()
+        return line
+
+    def flush(self):
+        if not self.buf:
+            return []
+        return [self.flush_one()]
 
 
 class AssertFailException(Exception):
@@ -46,6 +134,7 @@ class AssertSuccNotifier(Exception):
 
 
 class Action(object):
+    name = ''
 
     def __init__(self):
         pass
@@ -55,18 +144,21 @@ class Action(object):
 
 
 class CheckFail(Action):
+    name = 'CHECK-FAIL'
 
     def take(self, checker, line):
         checker.add_fail_line(line)
 
 
 class CheckSucc(Action):
+    name = 'CHECK-SUCC'
 
     def take(self, checker, line):
         checker.add_succ_line(line)
 
 
 class AssertFail(Action):
+    name = 'ASSERT-FAIL'
 
     def take(self, checker, line):
         checker.add_fail_line(line)
@@ -74,12 +166,180 @@ class AssertFail(Action):
 
 
 class AssertSucc(Action):
+    name = 'ASSERT-SUCC'
 
     def take(self, checker, line):
         checker.add_succ_line(line)
         raise AssertSuccNotifier()
 
 
+def read_peak_rss_kb(pid):
+    '''Returns the peak RSS of a running process in KiB, or None.'''
+    try:
+        with open(f'/proc/{pid}/status') as f:
+            for line in f:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1])
+    except (OSError, ValueError):
+        pass
+    return None
+
+
+CLOCK_TICKS = os.sysconf('SC_CLK_TCK') if hasattr(os, 'sysconf') else 100
+WATCHDOG_INTERVAL = 1
+WATCHDOG_WINDOW = 10
+DEFAULT_SPIN_TIMEOUT = 300
+DEFAULT_RESET_LIMIT = 20
+DEFAULT_GUEST_ERROR_LIMIT = 1000
+# A guest whose QEMU uses at least this share of a CPU is busy.
+SPIN_CPU_RATIO = 0.9
+CPU_RESET = re.compile(rb'^CPU Reset')
+# Register dumps following a reset and interrupt logging aren't errors.
+NOT_GUEST_ERROR = re.compile(
+    rb'^(?:\s|\.\.\.|[A-Za-z0-9_]+\s*=|Taking exception|Exception return)')
+
+
+def read_cpu_time(pid):
+    '''Returns user plus system CPU seconds of a process, None if unknown.'''
+    try:
+        with open(f'/proc/{pid}/stat') as f:
+            # The command name may contain spaces, fields follow its ')'.
+            fields = f.read().rsplit(')', 1)[1].split()
+    except (OSError, IndexError):
+        return None
+    return (int(fields[11]) + int(fields[12])) / CLOCK_TICKS
+
+
+class GuestWatchdog(object):
+    '''
+    Detects guests which won't finish anymore, so that they fail early
+    instead of occupying a slot until the timeouts expire:
+    - reset-loop: `reset_limit` CPU resets within WATCHDOG_WINDOW seconds,
+    - guest-error-storm: likewise `guest_error_limit` other entries of the
+      QEMU log, which are mostly guest_errors,
+    - spinning: no output for `spin_timeout` seconds while QEMU keeps a CPU
+      busy, a halted guest doesn't count.
+    The QEMU log is read from `syslog`, the file passed to `-D`. A limit of 0
+    disables the corresponding check.
+    '''
+
+    def __init__(self):
+        self.syslog = None
+        self.spin_timeout = DEFAULT_SPIN_TIMEOUT
+        self.reset_limit = DEFAULT_RESET_LIMIT
+        self.guest_error_limit = DEFAULT_GUEST_ERROR_LIMIT
+        self.resets = 0
+        self.guest_errors = 0
+        self.cpu_time = None
+        self.detail = None
+
+    def results(self):
+        return {
+            'syslog': self.syslog,
+            'resets': self.resets,
+            'guest_errors': self.guest_errors,
+            'cpu_time': self.cpu_time,
+            'detail': self.detail,
+        }
+
+    async def watch(self, checker, pid):
+        '''Returns the reason to abort, runs forever if there is none.'''
+        splitter = LineSplitter(MAX_LINE_LENGTH)
+        syslog = None
+        resets = collections.deque()
+        errors = collections.deque()
+        spin_start = None
+        output_bytes = -1
+        try:
+            while True:
+                await asyncio.sleep(WATCHDOG_INTERVAL)
+                now = time.monotonic()
+                if syslog is None and self.syslog is not None:
+                    try:
+                        syslog = open(self.syslog, 'rb')
+                    except OSError:
+                        pass
+                if syslog is not None:
+                    for line in splitter.feed(syslog.read()):
+                        if CPU_RESET.match(line):
+                            self.resets += 1
+                            resets.append(now)
+                        elif not NOT_GUEST_ERROR.match(line):
+                            self.guest_errors += 1
+                            errors.append(now)
+                for events in (resets, errors):
+                    while events and events[0] <= now - WATCHDOG_WINDOW:
+                        events.popleft()
+                if self.reset_limit and len(resets) >= self.reset_limit:
+                    self.detail = (f'{len(resets)} CPU resets within '
+                                   f'{WATCHDOG_WINDOW}s')
+                    return 'reset-loop'
+                if self.guest_error_limit and len(
+                        errors) >= self.guest_error_limit:
+                    self.detail = (f'{len(errors)} guest errors within '
+                                   f'{WATCHDOG_WINDOW}s')
+                    return 'guest-error-storm'
+
+                cpu_time = read_cpu_time(pid)
+                if cpu_time is None:
+                    continue
+                self.cpu_time = cpu_time
+                if checker.output_bytes != output_bytes:
+                    output_bytes = checker.output_bytes
+                    spin_start = (now, cpu_time)
+                    continue
+                silent = now - spin_start[0]
+                busy = cpu_time - spin_start[1]
+                if (self.spin_timeout and silent >= self.spin_timeout
+                        and busy >= SPIN_CPU_RATIO * silent):
+                    self.detail = (f'no output for {silent:.0f}s while using '
+                                   f'{busy:.0f}s of CPU')
+                    return 'spinning'
+        finally:
+            if syslog is not None:
+                syslog.close()
+
+
+SNAPSHOT_TAG = 'boot'
+
+# Bounds of what is kept in memory for chatty kernels.
+MAX_MATCHED_LINES = 1000
+MAX_MATCHES = 1000
+DEFAULT_TAIL_LINES = 100
+LOG_BUFFER_SIZE = 1 << 16
+READ_CHUNK_SIZE = 1 << 16
+MAX_LINE_LENGTH = 1 << 20
+
+
+def hash_files(*paths):
+    h = hashlib.sha256()
+    for path in paths:
+        with open(path, 'rb') as f:
+            while True:
+                chunk = f.read(1 << 20)
+                if not chunk:
+                    break
+                h.update(chunk)
+    return h.hexdigest()
+
+
+def copy_file(src, dst):
+    '''
+    Copies within the kernel, which shares blocks (reflink) on file systems
+    supporting it, and falls back to shutil.copyfile.
+    '''
+    if hasattr(os, 'copy_file_range'):
+        try:
+            with open(src, 'rb') as fsrc, open(dst, 'wb') as fdst:
+                while os.copy_file_range(fsrc.fileno(), fdst.fileno(),
+                                         1 << 30):
+                    pass
+            return
+        except OSError:
+            pass
+    shutil.copyfile(src, dst)
+
+
 class Checker(object):
 
     def __init__(self, script, test_dir):
@@ -87,9 +347,35 @@ class Checker(object):
         self.timeout = 1 << 30
         self.total_timeout = 1 << 30
         self.rules = []
-        self.succ_lines = []
-        self.fail_lines = []
+        # Built from rules in prepare(), lines not matching it are skipped.
+        self.prefilter = None
+        self.succ_lines = collections.deque(maxlen=MAX_MATCHED_LINES)
+        self.fail_lines = collections.deque(maxlen=MAX_MATCHED_LINES)
         self.test_dir = os.path.abspath(test_dir)
+        # QEMU output is echoed to stdout unless a log file is set. With a
+        # log file only the last lines are printed, when the check fails.
+        self.log_file = None
+        self.verbose = False
+        self.tail = collections.deque(maxlen=DEFAULT_TAIL_LINES)
+        # Statistics of the last run, see results().
+        self.start_time = None
+        self.line_time = None
+        self.line_no = 0
+        self.output_bytes = 0
+        self.first_output_time = None
+        self.assert_succ_time = None
+        self.wall_time = None
+        self.exit_reason = None
+        self.peak_rss_kb = None
+        self.matches = []
+        self.dropped_matches = 0
+        # See set_snapshot().
+        self.snapshot_marker = None
+        self.snapshot_image = None
+        self.snapshot_state = None
+        self.watchdog = GuestWatchdog()
+        # Number of times a failing test is run again, see run_with_retries().
+        self.retries = 0
 
     def add_succ_line(self, line):
         self.succ_lines.append(line)
@@ -127,58 +413,324 @@ class Checker(object):
         self.total_timeout = timeout
         return self
 
+    def set_log_file(self, log_file):
+        self.log_file = os.path.abspath(log_file)
+        return self
+
+    def set_retries(self, retries):
+        self.retries = retries
+        return self
+
+    def set_spin_timeout(self, timeout):
+        self.watchdog.spin_timeout = timeout
+        return self
+
+    def set_reset_limit(self, limit):
+        self.watchdog.reset_limit = limit
+        return self
+
+    def set_guest_error_limit(self, limit):
+        self.watchdog.guest_error_limit = limit
+        return self
+
+    def set_syslog(self, syslog):
+        '''Watches a QEMU log written by the runner script itself.'''
+        self.watchdog.syslog = os.path.abspath(syslog)
+        return self
+
+    def set_verbose(self, verbose):
+        self.verbose = verbose
+        return self
+
+    def set_tail_lines(self, n):
+        self.tail = collections.deque(maxlen=n)
+        return self
+
+    def set_snapshot(self, marker, image):
+        '''
+        Boots once to the first line matching `marker` and saves a snapshot
+        there, later runs start from that snapshot. Output before the marker
+        isn't printed again by restored runs, so rules shouldn't depend on
+        it. The runner script must be generated with `--snapshot`. Snapshots
+        are keyed by the hash of `image` and the runner script.
+        '''
+        self.snapshot_marker = marker
+        self.snapshot_image = os.path.abspath(image)
+        return self
+
+    def snapshot_dir(self):
+        return f'{self.script}.snapshots'
+
+    def prepare_snapshot(self, env, monitor):
+        key = hash_files(self.snapshot_image, self.script)
+        cached = os.path.join(self.snapshot_dir(), f'{key}.qcow2')
+        drive = os.path.join(self.test_dir, 'snapshot.qcow2')
+        if os.path.exists(drive):
+            os.unlink(drive)
+        if os.path.exists(cached):
+            # Not a qcow2 overlay, -loadvm only finds snapshots in the top
+            # image.
+            copy_file(cached, drive)
+            env['QEMU_LOADVM'] = SNAPSHOT_TAG
+            self.snapshot_state = 'restored'
+        else:
+            # Snapshots of older images are useless now.
+            if os.path.isdir(self.snapshot_dir()):
+                for name in os.listdir(self.snapshot_dir()):
+                    os.unlink(os.path.join(self.snapshot_dir(), name))
+            self.snapshot_state = 'cold'
+        env['QEMU_SNAPSHOT_DRIVE'] = drive
+        env['QEMU_MONITOR'] = monitor
+        return drive, cached
+
+    async def save_snapshot(self, monitor):
+        '''Saves a snapshot through the QEMU monitor.'''
+        try:
+            async with asyncio.timeout(delay=60):
+                reader, writer = await asyncio.open_unix_connection(monitor)
+                await reader.readuntil(b'(qemu) ')
+                writer.write(f'savevm {SNAPSHOT_TAG}\n'.encode())
+                await writer.drain()
+                reply = await reader.readuntil(b'(qemu) ')
+                writer.close()
+        except (OSError, asyncio.TimeoutError,
+                asyncio.IncompleteReadError) as e:
+            LOGGER.error(f'Failed to save snapshot: {e}')
+            self.snapshot_state = 'failed'
+            return
+        if b'Error' in reply:
+            LOGGER.error(f'Failed to save snapshot: {reply.decode()}')
+            self.snapshot_state = 'failed'
+            return
+        self.snapshot_state = 'saved'
+
+    def publish_snapshot(self, drive, cached):
+        # Writes after `savevm` don't change the saved snapshot.
+        os.makedirs(self.snapshot_dir(), exist_ok=True)
+        tmp = f'{cached}.{os.getpid()}.tmp'
+        copy_file(drive, tmp)
+        os.replace(tmp, cached)
+
     def check(self, line):
+        '''Checks a line of raw output, it's only decoded if a rule matches.'''
+        if self.prefilter is not None and not self.prefilter.search(line):
+            return
+        text = None
         for rule in self.rules:
-            m = rule.pattern.search(line)
+            m = rule.bytes_pattern.search(line)
             if m:
-                rule.action.take(self, line)
+                if text is None:
+                    text = line.decode(errors='replace')
+                self.record_match(rule)
+                rule.action.take(self, text)
 
-    def run_and_check(self):
+    def elapsed(self, t):
+        if t is None or self.start_time is None:
+            return None
+        return round(t - self.start_time, 6)
+
+    def record_match(self, rule):
+        elapsed = self.elapsed(self.line_time)
+        if isinstance(rule.action, AssertSucc):
+            self.assert_succ_time = elapsed
+        if len(self.matches) >= MAX_MATCHES and not isinstance(
+                rule.action, (AssertSucc, AssertFail)):
+            self.dropped_matches += 1
+            return
+        self.matches.append({
+            'directive': rule.action.name,
+            'pattern': rule.pattern.pattern,
+            'line_no': self.line_no,
+            'time': elapsed,
+        })
+
+    def sample_peak_rss(self, pid):
+        rss = read_peak_rss_kb(pid)
+        if rss is not None:
+            self.peak_rss_kb = max(rss, self.peak_rss_kb or 0)
+
+    def results(self):
+        return {
+            'script': self.script,
+            'test_dir': self.test_dir,
+            'exit_reason': self.exit_reason,
+            'lines': self.line_no,
+            'output_bytes': self.output_bytes,
+            'time_to_first_output': self.elapsed(self.first_output_time),
+            'time_to_assert_succ': self.assert_succ_time,
+            'wall_time': self.wall_time,
+            'peak_rss_kb': self.peak_rss_kb,
+            'snapshot': self.snapshot_state,
+            'watchdog': self.watchdog.results(),
+            'matches': self.matches,
+            'dropped_matches': self.dropped_matches,
+        }
+
+    def write_results(self, path):
+        with open(path, 'w') as f:
+            json.dump(self.results(), f, indent=2)
+
+    def prepare(self):
         self.rules.sort(key=lambda x: x.priority, reverse=True)
+        for rule in self.rules:
+            rule.bytes_pattern = to_bytes_pattern(rule.pattern)
+        self.prefilter = combine_rules(self.rules)
+        if self.snapshot_marker is not None:
+            self.snapshot_marker = to_bytes_pattern(self.snapshot_marker)
         # Create test directory if it doesn't exist
         os.makedirs(self.test_dir, exist_ok=True)
+        return self
+
+    def run_and_check(self):
+        self.prepare()
         return asyncio.run(self.go())
 
     async def go(self):
+        if self.log_file is None:
+            return await self.do_go(None)
+        # Raw serial output is streamed to the log through a large buffer.
+        with open(self.log_file, 'wb', buffering=LOG_BUFFER_SIZE) as log:
+            rc = await self.do_go(log)
+        if rc != 0 and not self.verbose and self.tail.maxlen:
+            self.print_tail()
+        return rc
+
+    def print_tail(self):
+        sys.stdout.write(f'Last {len(self.tail)} lines of {self.log_file}:\n' +
+                         b''.join(self.tail).decode(errors='replace'))
+        sys.stdout.flush()
+
+    async def do_go(self, log):
+        env = dict(os.environ)
+        # Runner scripts create their block image here, so that each test
+        # gets its own image.
+        env['QEMU_BLOCK_IMG'] = os.path.join(self.test_dir, 'block.img')
+        # Runner scripts supporting it write the QEMU log there for the
+        # watchdog.
+        if self.watchdog.syslog is None:
+            self.watchdog.syslog = os.path.join(self.test_dir, 'qemu.syslog')
+            env['QEMU_TRACE_LOG'] = self.watchdog.syslog
+            if os.path.exists(self.watchdog.syslog):
+                os.unlink(self.watchdog.syslog)
+        if self.snapshot_marker is None:
+            return await self.run_process(log, env)
+        # Test directories may be too long for a unix socket path.
+        with tempfile.TemporaryDirectory(prefix='qemu-') as tempdir:
+            monitor = os.path.join(tempdir, 'monitor.sock')
+            drive, cached = self.prepare_snapshot(env, monitor)
+            rc = await self.run_process(log, env, monitor)
+            if self.snapshot_state == 'saved':
+                self.publish_snapshot(drive, cached)
+            return rc
+
+    async def run_process(self, log, env, monitor=None):
+        self.start_time = time.monotonic()
+        # Output is captured, and a -nographic QEMU must not switch the
+        # terminal to raw mode, least of all many of them in a batch.
         process = await asyncio.create_subprocess_exec(
             self.script,
             cwd=self.test_dir,
+            env=env,
+            stdin=subprocess.DEVNULL,
             stdout=subprocess.PIPE,
             stderr=subprocess.STDOUT)
-        succ = False
+        succ = None
+        # Sample the peak RSS at the first line already.
+        last_sample = self.start_time - 1
+        last_newline = self.start_time
+        splitter = LineSplitter(MAX_LINE_LENGTH)
+        watchdog = asyncio.ensure_future(self.watchdog.watch(
+            self, process.pid))
+        read = None
         try:
             async with asyncio.timeout(delay=self.total_timeout):
-                while True:
-                    output_line = await asyncio.wait_for(
-                        process.stdout.readline(), timeout=self.timeout)
-                    if not output_line:
-                        break
-                    output_line = output_line.decode(errors='replace')
-                    sys.stdout.write(output_line)
-                    sys.stdout.flush()
-                    try:
-                        self.check(output_line)
-                    except AssertFailException:
+                while succ is None:
+                    # Output without a newline doesn't extend the timeout.
+                    remaining = self.timeout - (time.monotonic() -
+                                                last_newline)
+                    read = asyncio.ensure_future(
+                        process.stdout.read(READ_CHUNK_SIZE))
+                    await asyncio.wait((read, watchdog),
+                                       timeout=max(remaining, 0),
+                                       return_when=asyncio.FIRST_COMPLETED)
+                    if watchdog.done():
+                        self.exit_reason = watchdog.result()
+                        LOGGER.error(f'Watchdog: {self.exit_reason}, '
+                                     f'{self.watchdog.detail}')
                         succ = False
                         break
-                    except AssertSuccNotifier:
-                        succ = True
-                        break
+                    if not read.done():
+                        self.exit_reason = 'newline-timeout'
+                        raise asyncio.TimeoutError
+                    chunk = read.result()
+                    if chunk:
+                        lines = splitter.feed(chunk)
+                    else:
+                        lines = splitter.flush()
+                    self.line_time = time.monotonic()
+                    if chunk and self.first_output_time is None:
+                        self.first_output_time = self.line_time
+                    # Lines cut at MAX_LINE_LENGTH don't count.
+                    if b'\n' in chunk:
+                        last_newline = self.line_time
+                    # VmHWM only grows, sampling it now and then is enough.
+                    if self.line_time - last_sample >= 1:
+                        self.sample_peak_rss(process.pid)
+                        last_sample = self.line_time
+                    self.output_bytes += len(chunk)
+                    if log is not None:
+                        log.write(chunk)
+                    if log is None or self.verbose:
+                        sys.stdout.buffer.write(chunk)
+                        sys.stdout.flush()
+                    for line in lines:
+                        self.line_no += 1
+                        self.tail.append(line)
+                        if (self.snapshot_state == 'cold'
+                                and self.snapshot_marker.search(line)):
+                            await self.save_snapshot(monitor)
+                        try:
+                            self.check(line)
+                        except AssertFailException:
+                            self.exit_reason = 'assert-fail'
+                            succ = False
+                            break
+                        except AssertSuccNotifier:
+                            self.exit_reason = 'assert-succ'
+                            succ = True
+                            break
+                    if not chunk and succ is None:
+                        self.exit_reason = 'eof'
+                        succ = False
         except asyncio.TimeoutError:
             LOGGER.error('Check Timeout')
+            if self.exit_reason is None:
+                self.exit_reason = 'total-timeout'
             succ = False
+        finally:
+            for task in (read, watchdog):
+                if task is not None:
+                    task.cancel()
+        self.sample_peak_rss(process.pid)
         try:
-            process.kill()
+            # process.kill() polls the child first and may reap it behind the
+            # back of asyncio's child watcher, which then complains about an
+            # unknown child.
+            if process.returncode is None:
+                os.kill(process.pid, signal.SIGKILL)
         except Exception:
             pass
         finally:
             await process.wait()
+        self.wall_time = round(time.monotonic() - self.start_time, 6)
         LOGGER.info('Successful lines:')
         for line in self.succ_lines:
             LOGGER.info(line.strip())
         LOGGER.info('Failed lines:')
         for line in self.fail_lines:
             LOGGER.info(line.strip())
+        if log is not None:
+            log.write(b'Passed check\n' if succ else b'Failed check\n')
         if succ:
             LOGGER.info('Passed check')
             return 0
@@ -192,63 +744,416 @@ ASSERT_FAIL = re.compile(r'^//\s*ASSERT-FAIL:\s*(.*)$')
 ASSERT_SUCC = re.compile(r'^//\s*ASSERT-SUCC:\s*(.*)$')
 NEWLINE_TIMEOUT = re.compile(r'^//\s*NEWLINE-TIMEOUT:\s*(\d+)$')
 TOTAL_TIMEOUT = re.compile(r'^//\s*TOTAL-TIMEOUT:\s*(\d+)$')
+SPIN_TIMEOUT = re.compile(r'^//\s*SPIN-TIMEOUT:\s*(\d+)$')
+RESET_LIMIT = re.compile(r'^//\s*RESET-LIMIT:\s*(\d+)$')
+GUEST_ERROR_LIMIT = re.compile(r'^//\s*GUEST-ERROR-LIMIT:\s*(\d+)$')
+RETRIES = re.compile(r'^//\s*RETRIES:\s*(\d+)$')
+INCLUDE = re.compile(r'^//\s*INCLUDE:\s*(.*?)\s*$')
+
+# Directive, the Checker method it calls and the conversion of its value.
+DIRECTIVES = [
+    (CHECK_FAIL, 'add_check_fail', re.compile),
+    (CHECK_SUCC, 'add_check_succ', re.compile),
+    (ASSERT_FAIL, 'add_assert_fail', re.compile),
+    (ASSERT_SUCC, 'add_assert_succ', re.compile),
+    (NEWLINE_TIMEOUT, 'set_newline_timeout', int),
+    (TOTAL_TIMEOUT, 'set_total_timeout', int),
+    (SPIN_TIMEOUT, 'set_spin_timeout', int),
+    (RESET_LIMIT, 'set_reset_limit', int),
+    (GUEST_ERROR_LIMIT, 'set_guest_error_limit', int),
+    (RETRIES, 'set_retries', int),
+]
 
 
 class DirectiveParser(object):
+    '''
+    Parses the directives at the top of a check file, up to the first line
+    which isn't one. `// INCLUDE: path` applies the directives of another
+    file, relative paths are relative to the including file.
+    Parsed files are cached by the hash of their content, so a file used by
+    many tests of a batch is parsed and compiled only once.
+    '''
+
+    # Hash of file content -> list of (method or INCLUDE, value).
+    cache = {}
 
     def __init__(self, checker):
         self.checker = checker
 
-    def parse(self, filename):
-        with open(filename) as f:
-            for line in f:
-                m = CHECK_FAIL.match(line)
-                if m:
-                    self.checker.add_check_fail(re.compile(m.group(1)))
-                    continue
-                m = CHECK_SUCC.match(line)
-                if m:
-                    self.checker.add_check_succ(re.compile(m.group(1)))
-                    continue
-                m = ASSERT_FAIL.match(line)
-                if m:
-                    self.checker.add_assert_fail(re.compile(m.group(1)))
-                    continue
-                m = ASSERT_SUCC.match(line)
-                if m:
-                    self.checker.add_assert_succ(re.compile(m.group(1)))
-                    continue
-                m = NEWLINE_TIMEOUT.match(line)
-                if m:
-                    self.checker.set_newline_timeout(int(m.group(1)))
-                    continue
-                m = TOTAL_TIMEOUT.match(line)
+    @classmethod
+    def load(cls, filename):
+        with open(filename, 'rb') as f:
+            content = f.read()
+        key = hashlib.sha256(content).hexdigest()
+        directives = cls.cache.get(key)
+        if directives is not None:
+            return directives
+        directives = []
+        for line in content.decode().splitlines():
+            m = INCLUDE.match(line)
+            if m:
+                directives.append((INCLUDE, m.group(1)))
+                continue
+            for regex, method, convert in DIRECTIVES:
+                m = regex.match(line)
                 if m:
-                    self.checker.set_total_timeout(int(m.group(1)))
-                    continue
+                    directives.append((method, convert(m.group(1))))
+                    break
+            else:
                 break
+        cls.cache[key] = directives
+        return directives
+
+    def parse(self, filename, included=()):
+        filename = os.path.abspath(filename)
+        if filename in included:
+            LOGGER.error(f'{filename} includes itself')
+            return False
+        try:
+            directives = self.load(filename)
+        except (OSError, UnicodeDecodeError, re.error) as e:
+            LOGGER.error(f'Failed to parse {filename}: {e}')
+            return False
+        for method, value in directives:
+            if method is INCLUDE:
+                path = os.path.join(os.path.dirname(filename), value)
+                if not self.parse(path, included + (filename, )):
+                    return False
+                continue
+            getattr(self.checker, method)(value)
         return True
 
 
+PASS = 'pass'
+FLAKY = 'flaky'
+CONSISTENT_FAIL = 'consistent-fail'
+FLAKE_HISTORY = 'qemu_flakes.json'
+
+
+def retry_dir(test_dir, attempt):
+    '''Retries run in fresh directories within the test directory.'''
+    if attempt == 0:
+        return test_dir
+    return os.path.join(test_dir, f'retry{attempt}')
+
+
+async def run_with_retries(make_checker, retries=None):
+    '''
+    Runs a test, and runs it again while it fails, at most `retries` times,
+    which defaults to the RETRIES directive. `make_checker(attempt)` returns
+    a ready to run Checker for an attempt, or None if that fails.
+    Returns the outcome and the checkers of all attempts.
+    '''
+    checkers = []
+    attempt = 0
+    while True:
+        checker = make_checker(attempt)
+        if checker is None:
+            return CONSISTENT_FAIL, checkers
+        if attempt == 0 and retries is None:
+            retries = checker.retries
+        elif attempt > 0:
+            shutil.rmtree(checker.test_dir, ignore_errors=True)
+        checkers.append(checker)
+        if await checker.prepare().go() == 0:
+            return PASS if attempt == 0 else FLAKY, checkers
+        if attempt >= retries:
+            return CONSISTENT_FAIL, checkers
+        attempt += 1
+        LOGGER.warning(f'Retrying {checker.script} in '
+                       f'{retry_dir(checkers[0].test_dir, attempt)} '
+                       f'({attempt}/{retries})')
+
+
+def retry_results(outcome, checkers):
+    '''Results of the last attempt, with the outcome of all attempts.'''
+    results = checkers[-1].results() if checkers else {}
+    results['outcome'] = outcome
+    results['attempts'] = [c.exit_reason for c in checkers]
+    return results
+
+
+class FlakeHistory(object):
+    '''
+    Outcomes of tests over many runs, stored in a JSON file shared by
+    concurrent checkers and guarded by a lock file.
+    '''
+
+    def __init__(self, path):
+        self.path = os.path.abspath(path)
+        self.entries = {}
+
+    def load(self):
+        if os.path.exists(self.path):
+            with open(self.path) as f:
+                self.entries = json.load(f)
+        return self
+
+    def record(self, key, outcome):
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        with open(f'{self.path}.lock', 'w') as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            self.load()
+            entry = self.entries.setdefault(key, {
+                'runs': 0,
+                PASS: 0,
+                FLAKY: 0,
+                CONSISTENT_FAIL: 0,
+            })
+            entry['runs'] += 1
+            entry[outcome] += 1
+            entry['last'] = outcome
+            tmp = f'{self.path}.{os.getpid()}.tmp'
+            with open(tmp, 'w') as f:
+                json.dump(self.entries, f, indent=2, sort_keys=True)
+            os.replace(tmp, self.path)
+
+    def flake_rate(self, key):
+        entry = self.entries.get(key)
+        if not entry or not entry['runs']:
+            return 0.0
+        return entry[FLAKY] / entry['runs']
+
+    @staticmethod
+    def key(script, check_file):
+        return f'{os.path.abspath(script)}:{os.path.abspath(check_file)}'
+
+    @staticmethod
+    def default_path(test_dir):
+        return os.path.join(os.path.abspath(test_dir), FLAKE_HISTORY)
+
+    @staticmethod
+    def record_path(flake_history, retries, checkers):
+        '''
+        Returns where to record the outcome of a test, None if nowhere.
+        Outcomes are only recorded when asked for or when the test may be
+        retried, by default in its test directory.
+        '''
+        if flake_history:
+            return flake_history
+        if not checkers:
+            return None
+        if retries is None:
+            retries = checkers[0].retries
+        if retries > 0:
+            return FlakeHistory.default_path(checkers[0].test_dir)
+        return None
+
+
+def report_outcome(outcome, checkers):
+    if outcome == FLAKY:
+        LOGGER.warning(f'{checkers[0].script} is flaky, passed after '
+                       f'{len(checkers) - 1} retries')
+    elif outcome == CONSISTENT_FAIL and len(checkers) > 1:
+        LOGGER.error(f'{checkers[0].script} failed all {len(checkers)} '
+                     'attempts')
+
+
 def run_and_check(config):
-    checker = Checker(config.s, config.t)
-    directive_parser = DirectiveParser(checker)
-    if not directive_parser.parse(config.check_file):
+
+    def make_checker(attempt):
+        test_dir = retry_dir(config.t, attempt)
+        checker = Checker(config.s, test_dir)
+        directive_parser = DirectiveParser(checker)
+        if not directive_parser.parse(config.check_file):
+            return None
+        if config.log_file:
+            log_file = config.log_file
+            if attempt:
+                log_file = os.path.join(test_dir, os.path.basename(log_file))
+            checker.set_log_file(log_file)
+        checker.set_verbose(config.verbose).set_tail_lines(config.tail_lines)
+        if config.syslog:
+            checker.set_syslog(config.syslog)
+        if config.snapshot_marker:
+            checker.set_snapshot(re.compile(config.snapshot_marker),
+                                 config.snapshot_image)
+        return checker
+
+    if config.snapshot_marker and not config.snapshot_image:
+        LOGGER.error('--snapshot-marker requires --snapshot-image')
         return -1
-    return checker.run_and_check()
+    outcome, checkers = asyncio.run(
+        run_with_retries(make_checker, config.retries))
+    report_outcome(outcome, checkers)
+    history = FlakeHistory.record_path(config.flake_history, config.retries,
+                                       checkers)
+    if history:
+        FlakeHistory(history).record(
+            FlakeHistory.key(config.s, config.check_file), outcome)
+    if config.results_json:
+        with open(config.results_json, 'w') as f:
+            json.dump(retry_results(outcome, checkers), f, indent=2)
+    return -1 if outcome == CONSISTENT_FAIL else 0
+
+
+class BatchRunner(object):
+    '''
+    Runs the tests listed in a manifest concurrently on one event loop.
+    The manifest is a JSON list of objects with `runner`, `test_dir`,
+    `check_file` and optionally `retries`. The output of each test goes to
+    `qemu_checker.log` in its own test directory. Tests known to be flaky
+    are started last, so that they don't delay the others.
+    '''
+
+    def __init__(self, tests, jobs, retries=None, flake_history=None):
+        self.tests = tests
+        self.jobs = max(1, jobs)
+        self.retries = retries
+        self.flake_history = flake_history
+        self.histories = {}
+
+    @staticmethod
+    def load_manifest(manifest):
+        with open(manifest) as f:
+            return json.load(f)
+
+    def history(self, test):
+        return self.history_at(self.flake_history
+                               or FlakeHistory.default_path(test['test_dir']))
+
+    def history_at(self, path):
+        if path not in self.histories:
+            self.histories[path] = FlakeHistory(path).load()
+        return self.histories[path]
+
+    def flake_rate(self, test):
+        return self.history(test).flake_rate(
+            FlakeHistory.key(test['runner'], test['check_file']))
+
+    def schedule(self):
+        '''Returns indices of tests in manifest order, known-flaky last.'''
+        return sorted(range(len(self.tests)),
+                      key=lambda i: self.flake_rate(self.tests[i]))
+
+    async def run_test(self, test, sem):
+        async with sem:
+
+            def make_checker(attempt):
+                test_dir = retry_dir(test['test_dir'], attempt)
+                checker = Checker(test['runner'], test_dir)
+                checker.set_log_file(os.path.join(test_dir,
+                                                  'qemu_checker.log'))
+                if not DirectiveParser(checker).parse(test['check_file']):
+                    return None
+                return checker
+
+            start = time.monotonic()
+            retries = test.get('retries', self.retries)
+            outcome, checkers = await run_with_retries(make_checker, retries)
+            report_outcome(outcome, checkers)
+            history = FlakeHistory.record_path(self.flake_history, retries,
+                                               checkers)
+            if history:
+                self.history_at(history).record(
+                    FlakeHistory.key(test['runner'], test['check_file']),
+                    outcome)
+            log_file = checkers[-1].log_file if checkers else None
+            result = {
+                'runner': test['runner'],
+                'test_dir': os.path.abspath(test['test_dir']),
+                'check_file': test['check_file'],
+                'log_file': log_file,
+                'passed': outcome != CONSISTENT_FAIL,
+                'outcome': outcome,
+                'duration': round(time.monotonic() - start, 3),
+                'checker': retry_results(outcome, checkers),
+            }
+            status = {
+                PASS: 'PASS',
+                FLAKY: 'FLAKY',
+                CONSISTENT_FAIL: 'FAIL'
+            }[outcome]
+            print(f"{status} {test['check_file']} "
+                  f"({result['duration']}s), log: {log_file}")
+            sys.stdout.flush()
+            return result
+
+    async def go(self):
+        sem = asyncio.Semaphore(self.jobs)
+        # The semaphore is fair, so tests start in the scheduled order.
+        order = self.schedule()
+        results = await asyncio.gather(
+            *[self.run_test(self.tests[i], sem) for i in order])
+        return [result for _, result in sorted(zip(order, results))]
+
+    def run(self, results_file=None):
+        results = asyncio.run(self.go())
+        if results_file:
+            with open(results_file, 'w') as f:
+                json.dump(results, f, indent=2)
+        failed = [r for r in results if not r['passed']]
+        flaky = [r for r in results if r['outcome'] == FLAKY]
+        print(f'{len(results) - len(failed)}/{len(results)} test(s) passed, '
+              f'{len(flaky)} flaky')
+        if failed:
+            return -1
+        return 0
 
 
 def main():
     parser = argparse.ArgumentParser(
         description='QEMU checker for BlueOS kernel')
-    parser.add_argument('-s', help='The qemu runner script', required=True)
-    parser.add_argument('-t', help='The test directory', required=True)
+    parser.add_argument('-s', help='The qemu runner script')
+    parser.add_argument('-t', help='The test directory')
     parser.add_argument(
         'check_file',
+        nargs='?',
         help='File containing check directives',
     )
+    parser.add_argument(
+        '--batch',
+        help='Manifest of tests to run concurrently instead of -s/-t')
+    parser.add_argument('-j',
+                        '--jobs',
+                        type=int,
+                        default=os.cpu_count() or 1,
+                        help='Number of QEMU instances to run in batch mode')
+    parser.add_argument('--results',
+                        help='Aggregated result file of batch mode')
+    parser.add_argument(
+        '--results-json',
+        help='Write matched rules, timings and exit reason to this file')
+    parser.add_argument(
+        '--log-file',
+        help='Capture QEMU output to this file instead of the console')
+    parser.add_argument('--tail-lines',
+                        type=int,
+                        default=DEFAULT_TAIL_LINES,
+                        help='Number of last lines printed on failure')
+    parser.add_argument('-v',
+                        '--verbose',
+                        action='store_true',
+                        default=False,
+                        help='Echo QEMU output even when capturing it')
+    parser.add_argument(
+        '--snapshot-marker',
+        help='Save a snapshot at the first line matching this pattern and '
+        'start later runs from it')
+    parser.add_argument(
+        '--snapshot-image',
+        help='Kernel image whose hash invalidates saved snapshots')
+    parser.add_argument(
+        '--syslog',
+        help='QEMU log (-D) written by the runner script, watched for reset '
+        'loops and guest error storms')
+    parser.add_argument(
+        '--retries',
+        type=int,
+        help='Run a failing test again up to this many times, overrides the '
+        'RETRIES directive')
+    parser.add_argument(
+        '--flake-history',
+        help=f'File recording outcomes of tests. By default, tests which may be '
+        f'retried record them in {FLAKE_HISTORY} of their test directory')
 
     config = parser.parse_args()
+    if config.batch:
+        tests = BatchRunner.load_manifest(config.batch)
+        return BatchRunner(tests, config.jobs, config.retries,
+                           config.flake_history).run(config.results)
+    if not (config.s and config.t and config.check_file):
+        parser.error('-s, -t and check_file are required without --batch')
     return run_and_check(config)
 
 
@@ -0,0 +1,165 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# Copyright (c) 2025 vivo Mobile Communication Co., Ltd.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+'''
+Micro-benchmarks of the qemu_checker internals. Replays a captured QEMU log,
+or a synthetic one, against the rules of a check file, and reads it through
+a pipe like the output of QEMU.
+'''
+
+import os
+import sys
+import time
+import random
+import asyncio
+import argparse
+import tempfile
+from qemu_checker import Checker, DirectiveParser, AssertFailException, AssertSuccNotifier
+
+SYNTHETIC_WORDS = [
+    'Taking', 'exception', '5', '[IRQ]', '...from', 'EL1', 'to', 'ESR',
+    '0x0/0x0', 'ELR', '0xffff000040080000', 'SPSR', '0x600003c5', 'PSTATE',
+    'thread', 'scheduler', 'timer', 'tick', 'idle', 'cpu_reset'
+]
+
+
+def load_lines(config):
+    if config.log:
+        with open(config.log, 'rb') as f:
+            return f.readlines()
+    rng = random.Random(0)
+    return [(' '.join(rng.choice(SYNTHETIC_WORDS)
+                      for _ in range(12)) + '\n').encode()
+            for _ in range(config.lines)]
+
+
+def make_checker(check_file):
+    checker = Checker(sys.executable, os.getcwd())
+    DirectiveParser(checker).parse(check_file)
+    checker.prepare()
+    return checker
+
+
+def old_check(checker, line):
+    line = line.decode(errors='replace')
+    for rule in checker.rules:
+        m = rule.pattern.search(line)
+        if m:
+            rule.action.take(checker, line)
+
+
+def new_check(checker, line):
+    checker.check(line)
+
+
+def replay(check, checker, lines):
+    start = time.perf_counter()
+    for line in lines:
+        try:
+            check(checker, line)
+        except (AssertFailException, AssertSuccNotifier):
+            pass
+    return time.perf_counter() - start
+
+
+def bench_matcher(config, lines):
+    old = make_checker(config.check_file)
+    new = make_checker(config.check_file)
+    if new.prefilter is None:
+        print('Rules of the check file can not be combined')
+    old_time = min(replay(old_check, old, lines) for _ in range(config.repeat))
+    new_time = min(replay(new_check, new, lines) for _ in range(config.repeat))
+    assert old.succ_lines == new.succ_lines and old.fail_lines == new.fail_lines
+    print(f'{len(lines)} lines, {len(old.rules)} rules')
+    print(f'old matcher: {old_time:.3f}s, {len(lines) / old_time:.0f} lines/s')
+    print(f'new matcher: {new_time:.3f}s, {len(lines) / new_time:.0f} lines/s')
+    print(f'speedup    : {old_time / new_time:.2f}x')
+
+
+async def old_reader(script, checker):
+    '''The reader qemu_checker used to have: one readline() per line.'''
+    process = await asyncio.create_subprocess_exec(
+        script, stdout=asyncio.subprocess.PIPE)
+    lines = 0
+    while True:
+        line = await asyncio.wait_for(process.stdout.readline(),
+                                      timeout=checker.timeout)
+        if not line:
+            break
+        lines += 1
+        try:
+            old_check(checker, line)
+        except (AssertFailException, AssertSuccNotifier):
+            pass
+    await process.wait()
+    return lines
+
+
+def bench_reader(config, lines):
+    '''Pipes the log through `cat`, reading it with the old and new reader.'''
+    with tempfile.TemporaryDirectory() as tmp:
+        log = os.path.join(tmp, 'qemu.log')
+        with open(log, 'wb') as f:
+            f.writelines(lines)
+        script = os.path.join(tmp, 'cat.sh')
+        with open(script, 'w') as f:
+            f.write(f'#!/bin/sh\nexec cat {log}\n')
+        os.chmod(script, 0o755)
+
+        def run_old():
+            checker = make_checker(config.check_file)
+            start = time.perf_counter()
+            asyncio.run(old_reader(script, checker))
+            return time.perf_counter() - start
+
+        def run_new():
+            checker = Checker(script, os.path.join(tmp, 'test'))
+            checker.set_log_file(os.path.join(tmp, 'test', 'checker.log'))
+            checker.set_tail_lines(0)
+            DirectiveParser(checker).parse(config.check_file)
+            start = time.perf_counter()
+            checker.run_and_check()
+            return time.perf_counter() - start
+
+        old_time = min(run_old() for _ in range(config.repeat))
+        new_time = min(run_new() for _ in range(config.repeat))
+    print(f'old reader : {old_time:.3f}s, {len(lines) / old_time:.0f} lines/s')
+    print(f'new reader : {new_time:.3f}s, {len(lines) / new_time:.0f} lines/s')
+    print(f'speedup    : {old_time / new_time:.2f}x')
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Benchmark qemu_checker against a captured log')
+    parser.add_argument('--log',
+                        help='Captured QEMU output, synthetic if not given')
+    parser.add_argument('--lines',
+                        type=int,
+                        default=200000,
+                        help='Number of synthetic lines')
+    parser.add_argument('--repeat',
+                        type=int,
+                        default=3,
+                        help='Take the best of this many replays')
+    parser.add_argument('check_file', help='File containing check directives')
+    config = parser.parse_args()
+    lines = load_lines(config)
+    bench_matcher(config, lines)
+    bench_reader(config, lines)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -34,19 +34,24 @@
 # is currently:
 #
 # * Generated .rs files
-# * cargo:rustc-cfg output.
+# * cargo:rustc-cfg, rustc-link-lib, rustc-link-search and rustc-flags
+#   output, which end up in the flags file.
+# * cargo:rerun-if-changed output, which ends up in a ninja depfile.
 #
-# That's it. We don't even support the other standard cargo:rustc-
-# output messages.
+# All other cargo: output is recorded in the directives file, but has no
+# effect on the build.
 
 import argparse
-import io
+import hashlib
+import json
 import os
 import platform
 import re
+import shutil
 import subprocess
 import sys
 import tempfile
+import time
 
 # Set up path to be able to import action_helpers
 sys.path.append(
@@ -64,24 +69,29 @@ def rustc_name():
         return "rustc"
 
 
-def host_triple(rustc_path):
-    """ Works out the host rustc target. """
-    args = [rustc_path, "-vV"]
+def rustc_version(rustc_path):
+    """ Returns the output of `rustc -vV`, which identifies the toolchain. """
+    return subprocess.run([rustc_path, "-vV"],
+                          check=True,
+                          stdout=subprocess.PIPE,
+                          encoding="utf-8").stdout
+
+
+def host_triple(rustc_version):
+    """ Works out the host rustc target from `rustc -vV` output. """
     known_vars = dict()
-    proc = subprocess.Popen(args, stdout=subprocess.PIPE)
-    for line in io.TextIOWrapper(proc.stdout, encoding="utf-8"):
+    for line in rustc_version.splitlines():
         m = RUSTC_VERSION_LINE.match(line.rstrip())
         if m:
             known_vars[m.group(1)] = m.group(2)
     return known_vars["host"]
 
 
-def set_cargo_cfg_target_env_variables(rustc_print_cfg_path, env):
-    """ Sets `CARGO_CFG_TARGET_...` in `env` based on output from rustc.
-
-      `rustc_print_cfg_path` should be a path to the output of
-      `//build/rust/gni_impl:rustc_print_cfg`
+def parse_rustc_print_cfg(rustc_print_cfg_path):
+    """ Returns the `CARGO_CFG_TARGET_...` variables of a
+      `rustc --print cfg` output.
   """
+    cfg = {}
     with open(rustc_print_cfg_path, 'r') as file:
         for line in file:
             line = line.strip()
@@ -90,15 +100,470 @@ def set_cargo_cfg_target_env_variables(rustc_print_cfg_path, env):
             if key.startswith("target_"):
                 key = "CARGO_CFG_" + key.upper()
                 value = value.strip('"')
-                if key in env:
-                    env[key] = env[key] + f",{value}"
+                if key in cfg:
+                    cfg[key] = cfg[key] + f",{value}"
                 else:
-                    env[key] = value
+                    cfg[key] = value
+    return cfg
+
+
+def set_cargo_cfg_target_env_variables(rustc_print_cfg_path, env, cache=None):
+    """ Sets `CARGO_CFG_TARGET_...` in `env` based on output from rustc.
+
+      `rustc_print_cfg_path` should be a path to the output of
+      `rustc --print cfg`.
+  """
+    if cache is None:
+        cfg = parse_rustc_print_cfg(rustc_print_cfg_path)
+    else:
+        cfg = cache.get("print_cfg", rustc_print_cfg_path,
+                        parse_rustc_print_cfg)
+    env.update(cfg)
+
+
+def cache_dir():
+    """ Root of the on-disk caches shared by build actions. """
+    if os.environ.get("BLUEOS_CACHE_DIR"):
+        return os.environ["BLUEOS_CACHE_DIR"]
+    return os.path.join(
+        os.environ.get("XDG_CACHE_HOME", os.path.expanduser("~/.cache")),
+        "blueos")
+
+
+def rustup_stamp(path):
+    """ Returns what selects the toolchain if `path` is a rustup proxy, whose
+      own mtime stays the same when the toolchain changes.
+  """
+    dirname = os.path.dirname(os.path.abspath(path))
+    if not any(
+            os.path.exists(os.path.join(dirname, name))
+            for name in ("rustup", "rustup.exe")):
+        return ""
+    home = os.environ.get("RUSTUP_HOME", os.path.expanduser("~/.rustup"))
+    stamp = [os.environ.get("RUSTUP_TOOLCHAIN", "")]
+    for name in ("settings.toml", "toolchains"):
+        try:
+            stamp.append(str(os.stat(os.path.join(home, name)).st_mtime_ns))
+        except OSError:
+            stamp.append("-")
+    return "+" + "+".join(stamp)
+
+
+class ProbeCache(object):
+    """ Results of probing files like the rustc binary, keyed by path, mtime
+      and size of the file, and by the selected toolchain for rustup proxies.
+      Every build script action needs the same results, the cache saves each
+      of them from spawning rustc.
+  """
+
+    def __init__(self, path):
+        self.path = path
+        self.entries = None
+        self.dirty = False
+        # Seconds spent probing, and saved by cache hits.
+        self.spent = 0.0
+        self.saved = 0.0
+
+    def load(self):
+        try:
+            with open(self.path) as f:
+                self.entries = json.load(f)
+        except (OSError, ValueError):
+            self.entries = {}
+        return self
+
+    @staticmethod
+    def key(kind, path):
+        st = os.stat(path)
+        return "%s:%s:%d-%d%s" % (kind, os.path.realpath(path), st.st_mtime_ns,
+                                  st.st_size, rustup_stamp(path))
+
+    def get(self, kind, path, probe):
+        if self.entries is None:
+            self.load()
+        key = self.key(kind, path)
+        entry = self.entries.get(key)
+        if entry is not None:
+            self.saved += entry["time"]
+            return entry["value"]
+        start = time.perf_counter()
+        value = probe(path)
+        elapsed = time.perf_counter() - start
+        self.spent += elapsed
+        # Results for older versions of the same file are stale.
+        prefix = key.rsplit(":", 1)[0] + ":"
+        for stale in [k for k in self.entries if k.startswith(prefix)]:
+            del self.entries[stale]
+        self.entries[key] = {"value": value, "time": elapsed}
+        self.dirty = True
+        return value
+
+    def save(self):
+        if not self.dirty:
+            return
+        # Concurrent actions may race here, each write is atomic and a lost
+        # entry is just probed again.
+        try:
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+            tmp = "%s.%d.tmp" % (self.path, os.getpid())
+            with open(tmp, "w") as f:
+                json.dump(self.entries, f, indent=2, sort_keys=True)
+            os.replace(tmp, self.path)
+        except OSError:
+            pass
+        self.dirty = False
+
+
+# Bump when the layout of cache entries or the inputs of the key change.
+BUILD_SCRIPT_CACHE_VERSION = 4
+DEFAULT_BUILD_SCRIPT_CACHE_MB = 1024
+
+
+class BuildScriptCache(object):
+    """ Outputs of build scripts, addressed by a hash of everything the build
+      script gets to see: its binary, environment, rustc and the contents of
+      the inputs GN knows of. The cache is shared by all out dirs and evicts
+      the least recently used entries once it grows beyond `max_size` bytes.
+  """
+
+    def __init__(self, root, max_size):
+        self.root = root
+        self.max_size = max_size
+
+    @staticmethod
+    def key(build_script, env, generated_files, rustc_version, inputs):
+        h = hashlib.sha256()
+        h.update(b"%d\0" % BUILD_SCRIPT_CACHE_VERSION)
+        # Paths of inputs differ between out dirs, only contents count.
+        for path in [build_script] + (inputs or []):
+            h.update(b"%d\0" % os.path.getsize(path))
+            with open(path, "rb") as f:
+                for chunk in iter(lambda: f.read(1 << 20), b""):
+                    h.update(chunk)
+        h.update(
+            json.dumps([env, generated_files or [], rustc_version],
+                       sort_keys=True).encode("utf-8"))
+        return h.hexdigest()
+
+    @staticmethod
+    def cacheable(directives):
+        """ Without rerun-if-changed, cargo re-runs the build script on any
+          change of the package, which the key doesn't cover. Failed runs
+          aren't cached either.
+      """
+        return bool(directives["rerun_if_changed"]) and not directives["error"]
+
+    def lookup(self, key, manifest_dir):
+        """ Returns (directives, stderr, {generated file: (path, digest)}) or
+          None. Entries whose declared inputs changed since are a miss.
+      """
+        entry = os.path.join(self.root, key)
+        try:
+            with open(os.path.join(entry, "meta.json")) as f:
+                meta = json.load(f)
+            if declared_inputs(meta["directives"],
+                               manifest_dir) != meta["inputs"]:
+                return None
+            files = {
+                name: (os.path.join(entry, "files", name), digest)
+                for name, digest in meta["files"].items()
+            }
+            # The mtime of meta.json orders entries for eviction.
+            os.utime(os.path.join(entry, "meta.json"))
+        except (OSError, ValueError, KeyError):
+            return None
+        return meta["directives"], meta["stderr"], files
+
+    def store(self, key, directives, inputs, stderr, files):
+        try:
+            os.makedirs(self.root, exist_ok=True)
+            tmp = tempfile.mkdtemp(prefix=".tmp.", dir=self.root)
+        except OSError:
+            return
+        try:
+            size = len(stderr)
+            for name, (src, _) in files.items():
+                path = os.path.join(tmp, "files", name)
+                os.makedirs(os.path.dirname(path), exist_ok=True)
+                copy_file(src, path)
+                size += os.path.getsize(path)
+            with open(os.path.join(tmp, "meta.json"), "w") as f:
+                json.dump(
+                    {
+                        "directives": directives,
+                        "inputs": inputs,
+                        "stderr": stderr,
+                        "files": {
+                            name: digest
+                            for name, (_, digest) in files.items()
+                        },
+                        "size": size,
+                    }, f)
+            # An entry whose inputs changed is replaced.
+            self.remove(key)
+            # Fails if a concurrent action stored the same entry first.
+            os.rename(tmp, os.path.join(self.root, key))
+        except OSError:
+            shutil.rmtree(tmp, ignore_errors=True)
+            return
+        self.evict()
+
+    def evict(self):
+        entries = []
+        total = 0
+        for name in os.listdir(self.root):
+            if name.startswith("."):
+                continue
+            meta = os.path.join(self.root, name, "meta.json")
+            try:
+                mtime = os.stat(meta).st_mtime
+                with open(meta) as f:
+                    size = json.load(f)["size"]
+            except (OSError, ValueError, KeyError):
+                continue
+            entries.append((mtime, name, size))
+            total += size
+        entries.sort()
+        while entries and total > self.max_size:
+            _, name, size = entries.pop(0)
+            self.remove(name)
+            total -= size
+
+    def remove(self, key):
+        # Move the entry out of the way first, so that readers never see
+        # half of it.
+        doomed = os.path.join(self.root, ".evicted.%s.%d" % (key, os.getpid()))
+        try:
+            os.rename(os.path.join(self.root, key), doomed)
+        except OSError:
+            return
+        shutil.rmtree(doomed, ignore_errors=True)
+
+
+def build_script_cache():
+    """ Returns the shared build script cache, None if it is disabled. """
+    size_mb = int(
+        os.environ.get("BLUEOS_BUILD_SCRIPT_CACHE_MB",
+                       DEFAULT_BUILD_SCRIPT_CACHE_MB))
+    if size_mb <= 0:
+        return None
+    return BuildScriptCache(os.path.join(cache_dir(), "build_script"),
+                            size_mb << 20)
 
 
-# Before 1.77, the format was `cargo:rustc-cfg=`. As of 1.77 the format is now
-# `cargo::rustc-cfg=`.
-RUSTC_CFG_LINE = re.compile("cargo::?rustc-cfg=(.*)")
+def copy_file(src, dst):
+    """ Copies within the kernel, which can share blocks (reflink) on file
+      systems supporting it, and falls back to shutil.copyfile (sendfile).
+  """
+    if hasattr(os, "copy_file_range"):
+        try:
+            with open(src, "rb") as fsrc, open(dst, "wb") as fdst:
+                while os.copy_file_range(fsrc.fileno(), fdst.fileno(),
+                                         1 << 30):
+                    pass
+            return
+        except OSError:
+            pass
+    shutil.copyfile(src, dst)
+
+
+def publish_file(src, digest, dst, move):
+    """ Puts `src` at `dst` unless `dst` already has the same content, which
+      keeps its mtime. `src` is renamed if `move` is set, which requires the
+      same file system, and copied otherwise.
+  """
+    recorded = action_helpers.read_digest(dst)
+    current = recorded
+    if current is None and os.path.isfile(dst) and os.path.getsize(
+            dst) == os.path.getsize(src):
+        current = action_helpers.file_digest(dst)
+    written = current != digest
+    if written:
+        dirname = os.path.dirname(dst)
+        os.makedirs(dirname, exist_ok=True)
+        if move:
+            os.replace(src, dst)
+        else:
+            fd, tmp = tempfile.mkstemp(prefix=".tempfile.",
+                                       suffix="." + os.path.basename(dst),
+                                       dir=dirname)
+            os.close(fd)
+            try:
+                copy_file(src, tmp)
+                os.replace(tmp, dst)
+            finally:
+                if os.path.exists(tmp):
+                    os.unlink(tmp)
+    if written or recorded != digest:
+        action_helpers.write_digest(dst, digest)
+
+
+def write_outputs(args, directives, stderr, files, move):
+    directives = relocate_out_dir(directives, OUT_DIR_MARKER, args.out_dir)
+    if stderr.rstrip():
+        print(stderr.rstrip(), file=sys.stderr)
+    for warning in directives["warning"]:
+        print("warning: %s: %s" % (args.build_script, warning),
+              file=sys.stderr)
+    if directives["env"]:
+        print("warning: %s: rustc-env is not supported, ignoring %s" %
+              (args.build_script, ", ".join(sorted(directives["env"]))),
+              file=sys.stderr)
+    for error in directives["error"]:
+        print("error: %s: %s" % (args.build_script, error), file=sys.stderr)
+    if directives["error"]:
+        sys.exit(1)
+
+    # Only write to the file on disk if the content is different from what's
+    # currently on disk, which is known from its sidecar digest.
+    action_helpers.write_output_if_changed(
+        args.output,
+        rustc_flags(directives).encode("utf-8"))
+    if args.directives:
+        action_helpers.write_output_if_changed(
+            args.directives,
+            json.dumps(directives, indent=2, sort_keys=True).encode("utf-8"))
+    if args.depfile:
+        write_depfile(args.depfile, args.output, directives, args.src_dir)
+
+    # Move or copy any generated code out of the temporary directory or the
+    # cache, atomically.
+    for generated_file, (path, digest) in files.items():
+        publish_file(path, digest, os.path.join(args.out_dir, generated_file),
+                     move)
+
+
+# Before 1.77, the format was `cargo:KEY=VALUE`. As of 1.77 the format is now
+# `cargo::KEY=VALUE`, where unknown keys are an error instead of metadata.
+CARGO_DIRECTIVE_LINE = re.compile(r"cargo:(:?)([\w-]+)=(.*)")
+
+# Directives which may appear many times, in the order given.
+CARGO_LIST_DIRECTIVES = {
+    "rustc-cfg": "cfg",
+    "rustc-check-cfg": "check_cfg",
+    "rustc-link-lib": "link_lib",
+    "rustc-link-search": "link_search",
+    "rustc-flags": "flags",
+    "rerun-if-changed": "rerun_if_changed",
+    "rerun-if-env-changed": "rerun_if_env_changed",
+    "warning": "warning",
+}
+
+
+def parse_cargo_directives(stdout):
+    """ Parses the `cargo:` output of a build script into a dict. """
+    directives = {key: [] for key in CARGO_LIST_DIRECTIVES.values()}
+    directives.update({"link_arg": [], "error": [], "env": {}, "metadata": {}})
+    for line in stdout.split("\n"):
+        m = CARGO_DIRECTIVE_LINE.match(line.rstrip())
+        if not m:
+            continue
+        new_syntax, key, value = m.groups()
+        if key in CARGO_LIST_DIRECTIVES:
+            directives[CARGO_LIST_DIRECTIVES[key]].append(value)
+        elif key in ("rustc-link-arg", "rustc-cdylib-link-arg"
+                     ) or key.startswith("rustc-link-arg-"):
+            directives["link_arg"].append([key, value])
+        elif key == "rustc-env":
+            name, _, value = value.partition("=")
+            directives["env"][name] = value
+        elif key == "error" and new_syntax:
+            # Only an error as of the new syntax, metadata before.
+            directives["error"].append(value)
+        elif key == "metadata" and new_syntax:
+            name, _, value = value.partition("=")
+            directives["metadata"][name] = value
+        elif new_syntax:
+            directives["error"].append("unknown directive cargo::%s" % key)
+        else:
+            directives["metadata"][key] = value
+    return directives
+
+
+# Stands for the OUT_DIR of the build script in stored directives, which
+# refer to a temporary directory that is gone once the script has run.
+OUT_DIR_MARKER = "${OUT_DIR}"
+
+
+def relocate_out_dir(directives, old, new):
+    """ Returns `directives` with paths under `old` moved to `new`, in the
+      directives which end up in the flags file.
+  """
+    directives = dict(directives)
+    for key in ("link_search", "flags"):
+        directives[key] = [
+            value.replace(old, new) for value in directives[key]
+        ]
+    directives["link_arg"] = [[key, value.replace(old, new)]
+                              for key, value in directives["link_arg"]]
+    return directives
+
+
+def rustc_flags(directives):
+    """ Returns the contents of the flags file, one argument per line. """
+    flags = ""
+    for cfg in directives["cfg"]:
+        flags = "%s--cfg\n%s\n" % (flags, cfg)
+    for lib in directives["link_lib"]:
+        flags = "%s-l\n%s\n" % (flags, lib)
+    for path in directives["link_search"]:
+        flags = "%s-L\n%s\n" % (flags, path)
+    # Like cargo, only -l and -L are allowed in rustc-flags.
+    for value in directives["flags"]:
+        for flag, arg in re.findall(r"(-[lL])\s*(\S+)", value):
+            flags = "%s%s\n%s\n" % (flags, flag, arg)
+    return flags
+
+
+def rerun_paths(directives, manifest_dir):
+    """ Returns the files named by rerun-if-changed, with directories
+      expanded, relative to `manifest_dir` like the directives.
+  """
+    paths = []
+    for path in directives["rerun_if_changed"]:
+        full = os.path.join(manifest_dir, path)
+        if os.path.isdir(full):
+            for dirpath, dirnames, filenames in os.walk(full):
+                dirnames.sort()
+                for filename in sorted(filenames):
+                    paths.append(
+                        os.path.relpath(os.path.join(dirpath, filename),
+                                        manifest_dir))
+        else:
+            paths.append(path)
+    return paths
+
+
+def declared_inputs(directives, manifest_dir):
+    """ Returns the hashes of the rerun-if-changed files and the values of
+      the rerun-if-env-changed variables.
+  """
+    files = {}
+    for path in rerun_paths(directives, manifest_dir):
+        try:
+            with open(os.path.join(manifest_dir, path), "rb") as f:
+                files[path] = hashlib.sha256(f.read()).hexdigest()
+        except OSError:
+            files[path] = None
+    env = {
+        name: os.environ.get(name)
+        for name in directives["rerun_if_env_changed"]
+    }
+    return {"files": files, "env": env}
+
+
+def write_depfile(path, output, directives, manifest_dir):
+    """ Makes ninja re-run the build script when a declared input changes. """
+
+    def escape(path):
+        return path.replace(" ", "\\ ")
+
+    deps = [
+        escape(os.path.relpath(os.path.join(manifest_dir, p)))
+        for p in rerun_paths(directives, manifest_dir)
+    ]
+    with action_helpers.atomic_output(path, mode="w") as f:
+        f.write("%s: %s\n" % (escape(os.path.relpath(output)), " ".join(deps)))
 
 
 def main():
@@ -121,18 +586,83 @@ def main():
                         help='any generated file')
     parser.add_argument('--out-dir', required=True, help='target out dir')
     parser.add_argument('--src-dir', required=True, help='target source dir')
+    parser.add_argument('--rustc-print-cfg',
+                        help='output of `rustc --print cfg` for the target')
+    parser.add_argument('--directives',
+                        help='where to write all cargo: output as JSON')
+    parser.add_argument('--depfile',
+                        help='where to write a depfile of rerun-if-changed')
+    parser.add_argument('--inputs',
+                        nargs='+',
+                        help='files the build script reads, from GN')
 
     args = parser.parse_args()
-    try:
-        result = subprocess.run(['which', 'rustc'],
-                                capture_output=True,
-                                text=True,
-                                check=True)
-    except subprocess.CalledProcessError:
+    start = time.perf_counter()
+    rustc_path = shutil.which(rustc_name())
+    if rustc_path is None:
         print("Error: rustc not found in PATH or default location",
               file=sys.stderr)
         sys.exit(1)
-    rustc_path = result.stdout.strip()
+    probe_cache = ProbeCache(os.path.join(cache_dir(), "rustc_probe.json"))
+
+    env = {}  # try to avoid build scripts depending on other things
+    env["RUSTC"] = os.path.abspath(rustc_path)
+    env["CARGO_MANIFEST_DIR"] = os.path.abspath(args.src_dir)
+    version = probe_cache.get("version", rustc_path, rustc_version)
+    env["HOST"] = host_triple(version)
+    env["TARGET"] = args.target
+    env["CARGO_CFG_TARGET_ARCH"], *_ = env.get("TARGET").split("-")
+    if args.rustc_print_cfg:
+        set_cargo_cfg_target_env_variables(args.rustc_print_cfg, env,
+                                           probe_cache)
+    probe_cache.save()
+    probe_time = time.perf_counter() - start
+    if args.features:
+        for f in args.features:
+            feature_name = f.upper().replace("-", "_")
+            env["CARGO_FEATURE_%s" % feature_name] = "1"
+    if args.rustflags:
+        with open(args.rustflags) as flags:
+            for flag in flags:
+                if "-Copt-level" in flag:
+                    (_, opt) = flag.split("=")
+                    env["OPT_LEVEL"] = opt.rstrip()
+            flags.seek(0)
+            env["CARGO_ENCODED_RUSTFLAGS"] = '\x1f'.join(flags.readlines())
+    if args.env:
+        for e in args.env:
+            (k, v) = e.split("=")
+            env[k] = v
+    if "OPT_LEVEL" not in env:
+        env["OPT_LEVEL"] = "0"
+
+    # The same build script with the same environment gives the same
+    # outputs, whichever out dir it runs for. OUT_DIR and the diagnostic
+    # variables below don't take part in the key.
+    cache = build_script_cache()
+    key = None
+    if cache is not None:
+        key = BuildScriptCache.key(args.build_script, env,
+                                   args.generated_files, version, args.inputs)
+        cached = cache.lookup(key, env["CARGO_MANIFEST_DIR"])
+        if cached is not None:
+            directives, stderr, files = cached
+            if os.environ.get("BLUEOS_BUILD_SCRIPT_TIMING"):
+                print("%s: setup %.1fms, cache hit %s" %
+                      (args.build_script, probe_time * 1000, key[:12]),
+                      file=sys.stderr)
+            try:
+                write_outputs(args, directives, stderr, files, move=False)
+                return 0
+            except FileNotFoundError:
+                # Evicted by a concurrent action, run the build script.
+                pass
+
+    # Pass through a couple which are useful for diagnostics
+    if os.environ.get("RUST_BACKTRACE"):
+        env["RUST_BACKTRACE"] = os.environ.get("RUST_BACKTRACE")
+    if os.environ.get("RUST_LOG"):
+        env["RUST_LOG"] = os.environ.get("RUST_LOG")
 
     # We give the build script an OUT_DIR of a temporary directory,
     # and copy out only any files which gn directives say that it
@@ -144,75 +674,51 @@ def main():
     # we are always going to be reliant on code review to ensure the
     # build script is deterministic and trustworthy, so this would
     # really just be a backup to humans.
-    with tempfile.TemporaryDirectory() as tempdir:
-        env = {}  # try to avoid build scripts depending on other things
-        env["RUSTC"] = os.path.abspath(rustc_path)
+    # The directory is in the out dir, so that generated files can be renamed
+    # into place.
+    os.makedirs(args.out_dir, exist_ok=True)
+    with tempfile.TemporaryDirectory(prefix=".build_script.",
+                                     dir=os.path.abspath(
+                                         args.out_dir)) as tempdir:
         env["OUT_DIR"] = tempdir
-        env["CARGO_MANIFEST_DIR"] = os.path.abspath(args.src_dir)
-        env["HOST"] = host_triple(rustc_path)
-        env["TARGET"] = args.target
-        env["CARGO_CFG_TARGET_ARCH"], *_ = env.get("TARGET").split("-")
-        if args.features:
-            for f in args.features:
-                feature_name = f.upper().replace("-", "_")
-                env["CARGO_FEATURE_%s" % feature_name] = "1"
-        if args.rustflags:
-            with open(args.rustflags) as flags:
-                for flag in flags:
-                    if "-Copt-level" in flag:
-                        (_, opt) = flag.split("=")
-                        env["OPT_LEVEL"] = opt.rstrip()
-                flags.seek(0)
-                env["CARGO_ENCODED_RUSTFLAGS"] = '\x1f'.join(flags.readlines())
-        if args.env:
-            for e in args.env:
-                (k, v) = e.split("=")
-                env[k] = v
-        if "OPT_LEVEL" not in env:
-            env["OPT_LEVEL"] = "0"
-
-        # Pass through a couple which are useful for diagnostics
-        if os.environ.get("RUST_BACKTRACE"):
-            env["RUST_BACKTRACE"] = os.environ.get("RUST_BACKTRACE")
-        if os.environ.get("RUST_LOG"):
-            env["RUST_LOG"] = os.environ.get("RUST_LOG")
 
         # In the future we should, set all the variables listed here:
         # https://doc.rust-lang.org/cargo/reference/environment-variables.html#environment-variables-cargo-sets-for-build-scripts
+        start = time.perf_counter()
         proc = subprocess.run([os.path.abspath(args.build_script)],
                               env=env,
                               cwd=args.src_dir,
                               encoding='utf8',
                               stdout=subprocess.PIPE,
                               stderr=subprocess.PIPE)
-        if proc.stderr.rstrip():
+        if os.environ.get("BLUEOS_BUILD_SCRIPT_TIMING"):
+            print("%s: setup %.1fms (probing %.1fms, %.1fms saved by cache), "
+                  "build script %.1fms" %
+                  (args.build_script, probe_time * 1000,
+                   probe_cache.spent * 1000, probe_cache.saved * 1000,
+                   (time.perf_counter() - start) * 1000),
+                  file=sys.stderr)
+        if proc.returncode != 0 and proc.stderr.rstrip():
             print(proc.stderr.rstrip(), file=sys.stderr)
         proc.check_returncode()
 
-        flags = ""
-        for line in proc.stdout.split("\n"):
-            m = RUSTC_CFG_LINE.match(line.rstrip())
-            if m:
-                flags = "%s--cfg\n%s\n" % (flags, m.group(1))
+        # Stored with a marker, the cache entry is shared by all out dirs.
+        directives = relocate_out_dir(parse_cargo_directives(proc.stdout),
+                                      tempdir, OUT_DIR_MARKER)
 
-        # AtomicOutput will ensure we only write to the file on disk if what we
-        # give to write() is different than what's currently on disk.
-        with action_helpers.atomic_output(args.output) as output:
-            output.write(flags.encode("utf-8"))
-
-        # Copy any generated code out of the temporary directory,
-        # atomically.
+        files = {}
         if args.generated_files:
             for generated_file in args.generated_files:
                 in_path = os.path.join(tempdir, generated_file)
-                out_path = os.path.join(args.out_dir, generated_file)
-                out_dir = os.path.dirname(out_path)
-                if not os.path.exists(out_dir):
-                    os.makedirs(out_dir)
-                with open(in_path, 'rb') as input:
-                    with action_helpers.atomic_output(out_path) as output:
-                        content = input.read()
-                        output.write(content)
+                files[generated_file] = (in_path,
+                                         action_helpers.file_digest(in_path))
+
+        # Store before the generated files are moved out.
+        if cache is not None and BuildScriptCache.cacheable(directives):
+            cache.store(key, directives,
+                        declared_inputs(directives, env["CARGO_MANIFEST_DIR"]),
+                        proc.stderr, files)
+        write_outputs(args, directives, proc.stderr, files, move=True)
 
 
 if __name__ == '__main__':